@@ -0,0 +1,322 @@
+# Micro benchmarks, run with python -m neludim.bench [name]. Prints
+# microseconds per call
+
+
+import sys
+import random
+import asyncio
+import multiprocessing
+from time import perf_counter
+from timeit import timeit
+from tempfile import TemporaryDirectory
+from datetime import datetime as Datetime
+
+from .obj import (
+    User,
+    Contact,
+    Match,
+)
+from .dynamo import (
+    dynamo_client,
+    dynamo_batch_put,
+    dynamo_batch_get,
+    dynamo_batch_delete,
+    dynamo_scan,
+    dynamo_serialize_item,
+    dynamo_deserialize_item,
+    dynamo_encode_item,
+    dynamo_decode_item,
+)
+from .const import (
+    USERS_TABLE,
+    USERS_KEY,
+    DYNAMO_SCAN_SEGMENTS,
+    DYNAMO_BATCH_CONCURRENCY,
+    BENCH_DYNAMO,
+    BENCH_TABLE_PREFIX,
+    N,
+    CONFIRM_STATE,
+    FAIL_STATE,
+    GREAT_SCORE,
+    OK_SCORE,
+    GREEDY_MATCH_ENGINE,
+    EXACT_MATCH_ENGINE,
+)
+from .match import gen_matches
+from .history import gen_pair_histories
+from .sqlite import SqliteDB
+
+
+def bench_call(function, number):
+    return timeit(function, number=number) / number * 10 ** 6
+
+
+#######
+#
+#   DYNAMO CODEC
+#
+#####
+
+
+def bench_dynamo_codecs(number=100000):
+    objs = [
+        User(
+            user_id=113947584,
+            username='alexkuk',
+            created=Datetime(2022, 8, 15, 12),
+            name='Alexander Kukushkin',
+            city='Москва',
+            links='https://github.com/kuk',
+            about='Автор проекта Наташа',
+            updated_profile=Datetime(2022, 8, 15, 12),
+            agreed_participate=Datetime(2022, 8, 21, 9),
+            partner_user_id=1,
+        ),
+        Contact(
+            week_index=10,
+            user_id=113947584,
+            partner_user_id=1,
+            state='confirm',
+            feedback_score='great',
+        ),
+    ]
+    for obj in objs:
+        cls = obj.__class__
+        item = dynamo_serialize_item(obj)
+        yield cls.__name__, 'serialize generic', bench_call(lambda: dynamo_serialize_item(obj), number)
+        yield cls.__name__, 'serialize codec', bench_call(lambda: dynamo_encode_item(obj), number)
+        yield cls.__name__, 'deserialize generic', bench_call(lambda: dynamo_deserialize_item(item, cls), number)
+        yield cls.__name__, 'deserialize codec', bench_call(lambda: dynamo_decode_item(item, cls), number)
+
+
+#######
+#
+#   DB
+#
+#####
+
+
+# Same ops against sqlite and Dynamo. Dynamo only with BENCH_DYNAMO=1,
+# bench users go to separate {BENCH_TABLE_PREFIX}users table, created
+# on start, dropped on exit, DB always uses bot tables. Prints
+# microseconds per user
+
+
+def bench_users(size):
+    return [
+        User(
+            user_id=_,
+            username=f'user{_}',
+            name=f'User {_}',
+            city='Москва',
+            agreed_participate=Datetime(2022, 8, 21, 9),
+        )
+        for _ in range(size)
+    ]
+
+
+async def time_ops(ops, size):
+    for label, op in ops:
+        start = perf_counter()
+        await op()
+        yield label, (perf_counter() - start) / size * 10 ** 6
+
+
+async def bench_sqlite_ops(db, size):
+    users = bench_users(size)
+    user_ids = [_.user_id for _ in users]
+
+    async def put():
+        await db.put_users(users)
+
+    async def get():
+        await db.get_users(user_ids)
+
+    async def read():
+        await db.read_users()
+
+    async def delete():
+        await db.delete_users(user_ids)
+
+    ops = [('put', put), ('get', get), ('read', read), ('delete', delete)]
+    await db.connect()
+    try:
+        return [_ async for _ in time_ops(ops, size)]
+    finally:
+        await db.close()
+
+
+async def create_bench_table(client, table):
+    try:
+        await client.create_table(
+            TableName=table,
+            KeySchema=[{'AttributeName': USERS_KEY, 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': USERS_KEY, 'AttributeType': N}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+    except client.exceptions.ResourceInUseException:
+        # Left by crashed run, dropped on exit
+        pass
+
+    waiter = client.get_waiter('table_exists')
+    await waiter.wait(TableName=table)
+
+
+async def bench_dynamo_ops(size):
+    table = BENCH_TABLE_PREFIX + USERS_TABLE
+    items = [dynamo_encode_item(_) for _ in bench_users(size)]
+    keys = [{USERS_KEY: _[USERS_KEY]} for _ in items]
+
+    async def put():
+        await dynamo_batch_put(client, table, items, concurrency=DYNAMO_BATCH_CONCURRENCY)
+
+    async def get():
+        await dynamo_batch_get(client, table, keys, concurrency=DYNAMO_BATCH_CONCURRENCY)
+
+    async def read():
+        await dynamo_scan(client, table, segments=DYNAMO_SCAN_SEGMENTS)
+
+    async def delete():
+        await dynamo_batch_delete(client, table, keys, concurrency=DYNAMO_BATCH_CONCURRENCY)
+
+    ops = [('put', put), ('get', get), ('read', read), ('delete', delete)]
+    exit_stack, client = await dynamo_client()
+    try:
+        await create_bench_table(client, table)
+        try:
+            return [_ async for _ in time_ops(ops, size)]
+        finally:
+            await client.delete_table(TableName=table)
+    finally:
+        await exit_stack.aclose()
+
+
+def bench_db(size=10000):
+    with TemporaryDirectory() as dir:
+        db = SqliteDB(f'{dir}/bench.db')
+        for label, value in asyncio.run(bench_sqlite_ops(db, size)):
+            yield 'sqlite', label, value
+
+    if BENCH_DYNAMO and BENCH_TABLE_PREFIX:
+        for label, value in asyncio.run(bench_dynamo_ops(size)):
+            yield 'dynamo', label, value
+
+
+#######
+#
+#   MATCH
+#
+#####
+
+
+# Synthetic weeks: few cities, half users with about, history of
+# random pairs. Prints seconds per gen_matches call, number of users
+# without pair and of repeated pairs. History is aggregated once, same
+# as pair history table in prod. Exact is ~O(N^3), 1000 users takes
+# minutes. Every engine runs in child process, killed after timeout,
+# reported as 'timeout' row
+
+
+def bench_week(size, weeks=10, seed=0):
+    rng = random.Random(seed)
+    cities = ['Москва', 'Санкт-Петербург', 'Казань', 'Тбилиси', None]
+    users = [
+        User(
+            user_id=_,
+            city=rng.choice(cities),
+            about='about' if rng.random() < 0.5 else None,
+        )
+        for _ in range(size)
+    ]
+
+    contacts = []
+    for week_index in range(weeks):
+        user_ids = [_.user_id for _ in users]
+        rng.shuffle(user_ids)
+        for index in range(0, size - 1, 2):
+            contacts.append(Contact(
+                week_index=week_index,
+                user_id=user_ids[index],
+                partner_user_id=user_ids[index + 1],
+                state=rng.choice([CONFIRM_STATE, FAIL_STATE, None]),
+                feedback_score=rng.choice([GREAT_SCORE, OK_SCORE, None]),
+            ))
+
+    manual_matches = [
+        Match(*rng.sample(range(size), 2))
+        for _ in range(size // 100)
+    ]
+    return users, manual_matches, contacts, weeks
+
+
+def match_worker(conn, args, kwargs):
+    start = perf_counter()
+    matches = list(gen_matches(*args, **kwargs))
+    conn.send((perf_counter() - start, matches))
+
+
+def timed_matches(timeout, *args, **kwargs):
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=match_worker,
+        args=(child, args, kwargs)
+    )
+    process.start()
+    try:
+        if parent.poll(timeout):
+            return parent.recv()
+    finally:
+        process.terminate()
+        process.join()
+
+
+def bench_match(sizes=(100, 1000, 5000), timeout=600):
+    for size in sizes:
+        users, manual_matches, contacts, current_week_index = bench_week(size)
+        pair_histories = gen_pair_histories(contacts)
+        keys = {
+            (_.user_id, _.partner_user_id)
+            for _ in contacts
+        }
+
+        for engine in [GREEDY_MATCH_ENGINE, EXACT_MATCH_ENGINE]:
+            result = timed_matches(
+                timeout, users,
+                manual_matches=manual_matches,
+                pair_histories=pair_histories,
+                current_week_index=current_week_index,
+                engine=engine
+            )
+            if not result:
+                yield engine, size, 'timeout', timeout
+                continue
+
+            seconds, matches = result
+
+            no_pair = sum(_.partner_user_id is None for _ in matches)
+            repeat = sum(
+                (_.user_id, _.partner_user_id) in keys
+                or (_.partner_user_id, _.user_id) in keys
+                for _ in matches
+            )
+            yield engine, size, 'seconds', seconds
+            yield engine, size, 'no pair', no_pair
+            yield engine, size, 'repeat', repeat
+
+
+BENCHES = {
+    'codecs': bench_dynamo_codecs,
+    'db': bench_db,
+    'match': bench_match,
+}
+
+
+def main(argv):
+    names = argv[1:] or list(BENCHES)
+    for name in names:
+        for *labels, value in BENCHES[name]():
+            print(name, *labels, f'{value:.2f}', sep='\t')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
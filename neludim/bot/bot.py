@@ -1,13 +1,12 @@
 
 from aiogram import Bot
-from aiogram import Dispatcher  # noqa
+from aiogram import Dispatcher as BaseDispatcher
 
 from aiogram.types import ParseMode
 
 from neludim.const import BOT_TOKEN
 
 from .middlewares import setup_middlewares
-from .filters import setup_filters
 from .handlers import setup_handlers
 
 
@@ -19,7 +18,19 @@ def init_bot():
     )
 
 
+# One DB session per update around all handlers, see db.session.
+# Writes are flushed after update is processed, reads by key are
+# fetched once per update. Handler raised: buffered writes are
+# dropped, its error is passed on. Update middlewares run around
+# process_update, StatsMiddleware counts session flush
+
+
+class Dispatcher(BaseDispatcher):
+    async def process_update(self, update):
+        async with self.storage.db.session():
+            return await BaseDispatcher.process_update(self, update)
+
+
 def setup_bot(context):
     setup_middlewares(context)
-    setup_filters(context)
     setup_handlers(context)
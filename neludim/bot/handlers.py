@@ -1,6 +1,7 @@
 
 import random
 from functools import partial
+from dataclasses import asdict
 
 from aiogram.types import (
     InlineKeyboardMarkup,
@@ -11,6 +12,8 @@ from aiogram.utils import exceptions
 from neludim.const import (
     ADMIN_USER_ID,
 
+    USER_PARTICIPATE_FIELDS,
+
     START_COMMAND,
     HELP_COMMAND,
 
@@ -72,6 +75,22 @@ HAPPY_STICKERS = [
 ]
 
 
+######
+#
+#  STATE
+#
+#####
+
+
+# FSM state = data prefix, FSM data = data fields, both go to one
+# Chat item, see neludim.bot.storage
+
+
+async def set_state_data(state, data):
+    await state.set_state(data.prefix)
+    await state.set_data(asdict(data))
+
+
 #####
 #
 #  START
@@ -165,16 +184,13 @@ CANCEL_EDIT_MARKUP = InlineKeyboardMarkup().add(
 )
 
 
-async def handle_edit_name(context, query):
+async def handle_edit_name(context, query, state):
     await query.answer()
     await query.message.answer(
         text=EDIT_NAME_TEXT,
         reply_markup=CANCEL_EDIT_MARKUP
     )
-    await context.db.set_chat_state(
-        query.message.chat.id,
-        state=serialize_data(EditProfileData(NAME_FIELD))
-    )
+    await set_state_data(state, EditProfileData(NAME_FIELD))
 
 
 ######
@@ -189,16 +205,13 @@ EDIT_CITY_TEXT = '''Напиши город, в котором живёшь. С
 Примеры: Москва, Санкт-Петербург, Екатеринбург, Казань, Тбилиси, Ереван, Стамбул, Амстердам, Мюнхен, Париж.'''
 
 
-async def handle_edit_city(context, query):
+async def handle_edit_city(context, query, state):
     await query.answer()
     await query.message.answer(
         text=EDIT_CITY_TEXT,
         reply_markup=CANCEL_EDIT_MARKUP
     )
-    await context.db.set_chat_state(
-        query.message.chat.id,
-        serialize_data(EditProfileData(CITY_FIELD))
-    )
+    await set_state_data(state, EditProfileData(CITY_FIELD))
 
 
 #######
@@ -216,16 +229,13 @@ EDIT_LINKS_TEXT = '''Накидай ссылок про себя: блог, тв
 - http://val.maly.hk'''
 
 
-async def handle_edit_links(context, query):
+async def handle_edit_links(context, query, state):
     await query.answer()
     await query.message.answer(
         text=EDIT_LINKS_TEXT,
         reply_markup=CANCEL_EDIT_MARKUP
     )
-    await context.db.set_chat_state(
-        query.message.chat.id,
-        serialize_data(EditProfileData(LINKS_FIELD))
-    )
+    await set_state_data(state, EditProfileData(LINKS_FIELD))
 
 
 ######
@@ -253,16 +263,13 @@ EDIT_ABOUT_TEXT = '''Напиши о себе. Собеседник поймёт
 Только начинаю свое знакомство с NLP.  Интересно узнать от более опытных ребят про то, с чего лучше начать знакомство с этим направлением."'''
 
 
-async def handle_edit_about(context, query):
+async def handle_edit_about(context, query, state):
     await query.answer()
     await query.message.answer(
         text=EDIT_ABOUT_TEXT,
         reply_markup=CANCEL_EDIT_MARKUP
     )
-    await context.db.set_chat_state(
-        query.message.chat.id,
-        serialize_data(EditProfileData(ABOUT_FIELD))
-    )
+    await set_state_data(state, EditProfileData(ABOUT_FIELD))
 
 
 ########
@@ -284,28 +291,26 @@ def warn_city_text(city, cities=CITIES):
 - Тель Авив -> Тель-Авив'''
 
 
-async def handle_edit_input(context, message):
-    user = await context.db.get_user(message.from_user.id)
-    state = await context.db.get_chat_state(message.chat.id)
-    data = deserialize_data(state, EditProfileData)
+async def handle_edit_input(context, message, state):
+    data = EditProfileData(**await state.get_data())
 
-    if data.field == NAME_FIELD:
-        user.name = message.text
-    elif data.field == CITY_FIELD:
-        user.city = norm_city(message.text)
-    elif data.field == LINKS_FIELD:
-        user.links = message.text
-    elif data.field == ABOUT_FIELD:
-        user.about = message.text
+    if data.field == CITY_FIELD:
+        value = norm_city(message.text)
+    else:
+        value = message.text
 
-    user.updated_profile = context.schedule.now()
-    await context.db.put_user(user)
+    # Profile fields = User attrs, NAME_FIELD -> user.name etc
+    user = await context.db.update_user(
+        message.from_user.id,
+        **{data.field: value},
+        updated_profile=context.schedule.now()
+    )
 
     await message.answer(
         text=profile_text(user),
         reply_markup=EDIT_PROFILE_MARKUP
     )
-    await context.db.reset_chat_state(message.chat.id)
+    await state.finish()
 
     if data.field == CITY_FIELD and user.city not in CITIES:
         await message.answer(text=warn_city_text(user.city, CITIES))
@@ -326,10 +331,10 @@ async def safe_delete(message):
         pass
 
 
-async def handle_cancel_edit(context, query):
+async def handle_cancel_edit(context, query, state):
     await query.answer()
     await safe_delete(query.message)
-    await context.db.reset_chat_state(query.message.chat.id)
+    await state.finish()
 
 
 ######
@@ -379,11 +384,12 @@ async def handle_participate(context, query):
     await query.answer()
 
     current_week_index = context.schedule.current_week_index()
-    user = await context.db.get_user(query.from_user.id)
 
     if not data.agreed:
-        user.agreed_participate = None
-        await context.db.put_user(user)
+        await context.db.update_user(
+            query.from_user.id,
+            agreed_participate=None
+        )
 
         await query.message.answer(text=NO_PARTICIPATE_TEXT)
         return
@@ -392,16 +398,18 @@ async def handle_participate(context, query):
         await query.message.answer(text=LATE_PARTICIPATE_TEXT)
         return
 
-    user.username = query.from_user.username
-    if not user.username:
+    if not query.from_user.username:
         await query.message.answer(
             text=NO_USERNAME_TEXT,
             reply_markup=no_username_markup(data.week_index)
         )
         return
 
-    user.agreed_participate = context.schedule.now()
-    await context.db.put_user(user)
+    user = await context.db.update_user(
+        query.from_user.id,
+        username=query.from_user.username,
+        agreed_participate=context.schedule.now()
+    )
 
     await query.message.reply_sticker(
         sticker=random.choice(HAPPY_STICKERS)
@@ -470,7 +478,7 @@ def admin_feedback_text(user, partner_user, contact):
 {contact.feedback_text}'''
 
 
-async def handle_feedback(context, query):
+async def handle_feedback(context, query, state):
     data = deserialize_data(query.data, FeedbackData)
     await query.answer()
 
@@ -479,11 +487,16 @@ async def handle_feedback(context, query):
         query.from_user.id,
         data.partner_user_id
     )
-    contact = await context.db.get_contact(key)
-    contact.state = data.state
-    if contact.state == CONFIRM_STATE:
-        contact.feedback_score = data.feedback_score
-    await context.db.put_contact(contact)
+    fields = {'state': data.state}
+    if data.state == CONFIRM_STATE:
+        fields['feedback_score'] = data.feedback_score
+    contact = await context.db.update_contact(key, **fields)
+    if not contact:
+        # Old week, moved to archive, see archive_contacts
+        return
+
+    # Changed answer overwrites own side, see neludim.history
+    await context.db.merge_pair_histories([contact])
 
     if contact.state == FAIL_STATE:
         text = FAIL_FEEDBACK_TEXT
@@ -496,43 +509,42 @@ async def handle_feedback(context, query):
         text=text,
         reply_markup=CANCEL_FEEDBACK_MARKUP
     )
-    await context.db.set_chat_state(
-        query.message.chat.id,
-        serialize_data(FeedbackData(
-            data.week_index,
-            data.partner_user_id
-        ))
-    )
+    await set_state_data(state, FeedbackData(
+        data.week_index,
+        data.partner_user_id
+    ))
 
 
-async def handle_cancel_feedback(context, query):
+async def handle_cancel_feedback(context, query, state):
     await query.answer()
     await query.message.answer(
         text=ANYWAY_THANK_FEEDBACK_TEXT
     )
-    await context.db.reset_chat_state(query.message.chat.id)
+    await state.finish()
 
 
-async def handle_feedback_input(context, message):
-    state = await context.db.get_chat_state(message.chat.id)
-    data = deserialize_data(state, FeedbackData)
+async def handle_feedback_input(context, message, state):
+    data = FeedbackData(**await state.get_data())
 
     key = (
         data.week_index,
         message.from_user.id,
         data.partner_user_id
     )
-    contact = await context.db.get_contact(key)
-    contact.feedback_text = message.text
-    await context.db.put_contact(contact)
+    contact = await context.db.update_contact(
+        key,
+        feedback_text=message.text
+    )
 
     await message.answer(
         text=THANK_FEEDBACK_TEXT
     )
-    await context.db.reset_chat_state(message.chat.id)
+    await state.finish()
 
-    user = await context.db.get_user(contact.user_id)
-    partner_user = await context.db.get_user(contact.partner_user_id)
+    user, partner_user = await context.db.get_users([
+        contact.user_id,
+        contact.partner_user_id
+    ])
     await context.bot.send_message(
         chat_id=ADMIN_USER_ID,
         text=admin_feedback_text(user, partner_user, contact)
@@ -618,7 +630,7 @@ def manual_match_text(user, partner_user):
 
 
 async def manual_match_users(context):
-    users = await context.db.read_users()
+    users = await context.db.read_users(fields=USER_PARTICIPATE_FIELDS)
     current_week_index = context.schedule.current_week_index()
     users = [
         _ for _ in users
@@ -646,16 +658,20 @@ async def handle_manual_match(context, query):
         )
 
     elif data.action == SELECT_PARTNER_USER_ACTION:
-        user = await context.db.get_user(data.user_id)
-        partner_user = await context.db.get_user(data.partner_user_id)
+        user, partner_user = await context.db.get_users([
+            data.user_id,
+            data.partner_user_id
+        ])
         await query.message.edit_text(
             text=confirm_manual_match_text(user, partner_user),
             reply_markup=confirm_manual_match_markup(user, partner_user)
         )
 
     elif data.action == CONFIRM_ACTION:
-        user = await context.db.get_user(data.user_id)
-        partner_user = await context.db.get_user(data.partner_user_id)
+        user, partner_user = await context.db.get_users([
+            data.user_id,
+            data.partner_user_id
+        ])
         match = Match(user.user_id, partner_user.user_id)
         await context.db.put_manual_match(match)
         await context.bot.send_message(
@@ -724,70 +740,83 @@ def setup_handlers(context):
     context.dispatcher.register_message_handler(
         partial(handle_start, context),
         commands=START_COMMAND,
+        state='*'
     )
 
     context.dispatcher.register_callback_query_handler(
         partial(handle_edit_profile, context),
-        text=serialize_data(EditProfileData())
+        text=serialize_data(EditProfileData()),
+        state='*'
     )
     context.dispatcher.register_callback_query_handler(
         partial(handle_edit_name, context),
-        text=serialize_data(EditProfileData(NAME_FIELD))
+        text=serialize_data(EditProfileData(NAME_FIELD)),
+        state='*'
     )
     context.dispatcher.register_callback_query_handler(
         partial(handle_edit_city, context),
-        text=serialize_data(EditProfileData(CITY_FIELD))
+        text=serialize_data(EditProfileData(CITY_FIELD)),
+        state='*'
     )
     context.dispatcher.register_callback_query_handler(
         partial(handle_edit_links, context),
-        text=serialize_data(EditProfileData(LINKS_FIELD))
+        text=serialize_data(EditProfileData(LINKS_FIELD)),
+        state='*'
     )
     context.dispatcher.register_callback_query_handler(
         partial(handle_edit_about, context),
-        text=serialize_data(EditProfileData(ABOUT_FIELD))
+        text=serialize_data(EditProfileData(ABOUT_FIELD)),
+        state='*'
     )
     context.dispatcher.register_callback_query_handler(
         partial(handle_cancel_edit, context),
         text=CANCEL_EDIT_DATA,
+        state='*'
     )
 
     context.dispatcher.register_callback_query_handler(
         partial(handle_participate, context),
-        text_startswith=PARTICIPATE_PREFIX
+        text_startswith=PARTICIPATE_PREFIX,
+        state='*'
     )
 
     context.dispatcher.register_callback_query_handler(
         partial(handle_feedback, context),
-        text_startswith=FEEDBACK_PREFIX
+        text_startswith=FEEDBACK_PREFIX,
+        state='*'
     )
     context.dispatcher.register_callback_query_handler(
         partial(handle_cancel_feedback, context),
-        text=CANCEL_FEEDBACK_DATA
+        text=CANCEL_FEEDBACK_DATA,
+        state='*'
     )
 
     context.dispatcher.register_callback_query_handler(
         partial(handle_manual_match, context),
-        text_startswith=MANUAL_MATCH_PREFIX
+        text_startswith=MANUAL_MATCH_PREFIX,
+        state='*'
     )
 
     context.dispatcher.register_message_handler(
         partial(handle_help, context),
         commands=HELP_COMMAND,
+        state='*'
     )
 
-    # Every call to chat_states filter = db query. Place handlers
-    # last. TODO Implement aiogram storage adapter for DynamoDB,
-    # natively handle FSM
+    # Handlers without state filter get state=None by default, see
+    # aiogram StateFilter. Commands and buttons work in any state,
+    # text input is routed by state
 
     context.dispatcher.register_message_handler(
         partial(handle_edit_input, context),
-        chat_state_startswith=EDIT_PROFILE_PREFIX
+        state=EDIT_PROFILE_PREFIX
     )
     context.dispatcher.register_message_handler(
         partial(handle_feedback_input, context),
-        chat_state_startswith=FEEDBACK_PREFIX
+        state=FEEDBACK_PREFIX
     )
 
     context.dispatcher.register_message_handler(
-        partial(handle_other, context)
+        partial(handle_other, context),
+        state='*'
     )
@@ -7,6 +7,8 @@ from neludim.log import (
     log,
     json_msg
 )
+from neludim.throttle import PRIORITY
+from neludim.stats import stats_scope
 
 
 class PrivateMiddleware(BaseMiddleware):
@@ -35,10 +37,42 @@ class LoggingMiddleware(BaseMiddleware):
         ))
 
 
+# User waits for reply, DB calls skip client side throttle queue. Each
+# update is handled in own task, contextvar does not leak
+
+
+class PriorityMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update, data):
+        PRIORITY.set(True)
+
+
+# Dynamo stats per update. Post process runs after
+# Dispatcher.process_update returned or raised, session flush is
+# counted
+
+
+class StatsMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update, data):
+        scope = stats_scope()
+        stats = scope.__enter__()
+        data['stats_scope'] = (scope, stats)
+
+    async def on_post_process_update(self, update, results, data):
+        scope, stats = data.pop('stats_scope')
+        scope.__exit__(None, None, None)
+        if stats.ops:
+            log.info(json_msg(
+                update_id=update.update_id,
+                dynamo=stats.summary()
+            ))
+
+
 def setup_middlewares(context):
     middlewares = [
         PrivateMiddleware(),
         LoggingMiddleware(),
+        PriorityMiddleware(),
+        StatsMiddleware(),
     ]
     for middleware in middlewares:
         context.dispatcher.middleware.setup(middleware)
@@ -1,4 +1,10 @@
 
+from json import (
+    loads as parse_json,
+    dumps as format_json
+)
+from collections import defaultdict
+
 from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -7,6 +13,16 @@ from aiogram.types import (
 from neludim.const import (
     ADMIN_USER_ID,
 
+    USER_KEY_FIELDS,
+    CONTACT_KEY_FIELDS,
+    USER_MENTION_FIELDS,
+    USER_PARTICIPATE_FIELDS,
+    USER_PARTNER_FIELDS,
+    USER_MATCH_FIELDS,
+    CONTACT_STATS_FIELDS,
+
+    CONTACTS_HOT_WEEKS,
+
     CONFIRM_STATE,
     FAIL_STATE,
 
@@ -24,7 +40,11 @@ from neludim.text import (
 )
 
 from neludim.schedule import week_index
-from neludim.obj import Contact
+from neludim.obj import (
+    Contact,
+    Match,
+    Progress,
+)
 
 from neludim.match import gen_matches
 from neludim.report import (
@@ -71,7 +91,7 @@ def ask_participate_markup(context):
 
 
 async def ask_participate(context):
-    users = await context.db.read_users()
+    users = await context.db.read_users(fields=USER_KEY_FIELDS)
 
     for user in users:
         await context.broadcast.send_message(
@@ -81,6 +101,62 @@ async def ask_participate(context):
         )
 
 
+######
+#
+#   CONTACTS HISTORY
+#
+####
+
+
+# Hot table keeps last CONTACTS_HOT_WEEKS weeks, older are in archive,
+# item per week. Archive is written before hot contacts are deleted,
+# week may be in both, prefer archive
+
+
+async def read_contacts_history(context):
+    archive_contacts = await context.db.read_archive_contacts()
+    archive_week_indexes = {_.week_index for _ in archive_contacts}
+
+    contacts = await context.db.read_contacts(fields=CONTACT_STATS_FIELDS)
+    return archive_contacts + [
+        _ for _ in contacts
+        if _.week_index not in archive_week_indexes
+    ]
+
+
+# Rerun after crash: week already archived, only delete hot contacts,
+# do not overwrite archive with partial week
+
+
+async def archive_contacts(context):
+    horizon = context.schedule.current_week_index() - CONTACTS_HOT_WEEKS
+
+    week_contacts = defaultdict(list)
+    contacts = context.db.iter_contacts(
+        filter=lambda _: _.week_index < horizon
+    )
+    async for contact in contacts:
+        week_contacts[contact.week_index].append(contact)
+
+    archive_contacts = await context.db.read_archive_contacts()
+    archive_week_indexes = {_.week_index for _ in archive_contacts}
+
+    for index, contacts in sorted(week_contacts.items()):
+        if index not in archive_week_indexes:
+            await context.db.put_archive_week(index, contacts)
+        await context.db.delete_contacts(_.key for _ in contacts)
+
+
+# Pair history is merged on every contacts write, see
+# neludim.history. Fill from full history: first deploy, after restore
+# from snapshot. Sets sides again, safe to rerun
+
+
+async def backfill_pair_history(context):
+    contacts = await read_contacts_history(context)
+    await context.db.merge_pair_histories(contacts)
+
+
 ######
 #
 #   CREATE CONTACTS
@@ -88,59 +164,125 @@ async def ask_participate(context):
 ####
 
 
-async def create_contacts(context):
-    users = await context.db.read_users()
-    contacts = await context.db.read_contacts()
-    manual_matches = await context.db.read_manual_matches()
-    current_week_index = context.schedule.current_week_index()
+# Matches are random, stored in progress item before commit. Commit
+# is chunked and resumable, see db.commit_contacts. Rerun after
+# timeout reuses stored matches, skips committed chunks
 
-    participate_users = [
-        _ for _ in users
-        if (
-                _.agreed_participate
-                and week_index(_.agreed_participate) == current_week_index - 1
-        )
+
+def contacts_progress_key(week_index):
+    return f'create_contacts#{week_index}'
+
+
+def format_matches(matches):
+    return format_json([
+        [_.user_id, _.partner_user_id]
+        for _ in matches
+    ])
+
+
+def parse_matches(data):
+    return [
+        Match(user_id, partner_user_id)
+        for user_id, partner_user_id in parse_json(data)
     ]
-    matches = list(gen_matches(
-        participate_users,
-        manual_matches=manual_matches,
-        contacts=contacts,
-        current_week_index=current_week_index,
-    ))
 
-    contacts = []
+
+def match_groups(matches, week_index):
     for match in matches:
         user_id, partner_user_id = match.key
 
-        contacts.append(Contact(
-            week_index=current_week_index,
-            user_id=user_id,
-            partner_user_id=partner_user_id
-        ))
+        contacts = [
+            Contact(
+                week_index=week_index,
+                user_id=user_id,
+                partner_user_id=partner_user_id
+            )
+        ]
+        user_partner_ids = {user_id: partner_user_id}
 
         if partner_user_id:
             contacts.append(Contact(
-                week_index=current_week_index,
+                week_index=week_index,
                 user_id=partner_user_id,
                 partner_user_id=user_id
             ))
+            user_partner_ids[partner_user_id] = user_id
 
-    for user in users:
-        user.partner_user_id = None
+        yield contacts, user_partner_ids
 
-    id_users = {_.user_id: _ for _ in users}
-    for match in matches:
-        user_id, partner_user_id = match.key
 
-        user = id_users[user_id]
-        user.partner_user_id = partner_user_id
+async def gen_week_matches(context, users, current_week_index):
+    pair_histories = await context.db.read_pair_histories()
+    manual_matches = await context.db.read_manual_matches()
 
-        if partner_user_id:
-            partner_user = id_users[partner_user_id]
-            partner_user.partner_user_id = user_id
+    participate_users = [
+        _ for _ in users
+        if (
+                _.agreed_participate
+                and week_index(_.agreed_participate) == current_week_index - 1
+        )
+    ]
+    # Links, about are large, fetch only for participants. User may be
+    # deleted since read, None
+    participate_users = await context.db.get_users(
+        (_.user_id for _ in participate_users),
+        fields=USER_MATCH_FIELDS
+    )
+    participate_users = [_ for _ in participate_users if _]
+    return list(gen_matches(
+        participate_users,
+        manual_matches=manual_matches,
+        pair_histories=pair_histories,
+        current_week_index=current_week_index,
+    ))
 
-    await context.db.put_contacts(contacts)
-    await context.db.put_users(users)
+
+async def create_contacts(context):
+    current_week_index = context.schedule.current_week_index()
+    key = contacts_progress_key(current_week_index)
+    progress = await context.db.get_progress(key)
+    if progress and progress.done:
+        return
+
+    users = await context.db.read_users(fields=USER_PARTNER_FIELDS)
+    if progress:
+        matches = parse_matches(progress.data)
+    else:
+        matches = await gen_week_matches(context, users, current_week_index)
+        progress = Progress(key, data=format_matches(matches))
+        await context.db.put_progress(progress)
+
+    groups = list(match_groups(matches, current_week_index))
+    failed = await context.db.commit_contacts(key, groups)
+    if failed:
+        return
+
+    # Merge is idempotent, rerun after crash merges week again. Not
+    # buffered in session, week is marked done only after merge is
+    # stored
+    failed = await context.db.merge_pair_histories(
+        contact
+        for contacts, _ in groups
+        for contact in contacts
+    )
+    if failed:
+        return
+
+    # Matched users are updated in commit. Reset partner of the rest,
+    # update only changed, do not overwrite other fields, user may be
+    # editing profile right now
+    user_partner_ids = {}
+    for _, group_user_partner_ids in groups:
+        user_partner_ids.update(group_user_partner_ids)
+
+    await context.db.update_users(
+        (user.user_id, {'partner_user_id': None})
+        for user in users
+        if user.user_id not in user_partner_ids and user.partner_user_id
+    )
+
+    progress.done = context.schedule.now()
+    await context.db.put_progress(progress)
 
 
 ######
@@ -162,15 +304,22 @@ def no_contact_text(context):
 Бот пришлёт новое приглашение в конце недели. Если согласишься участвовать, бот повторит попытку в понедельник {day_month(context.schedule.next_week_monday())}.'''
 
 
-async def send_contacts(context):
-    id_users = {
-        _.user_id: _
-        for _ in await context.db.read_users()
+async def get_partner_users(context, contacts, fields=None):
+    user_ids = {
+        _.partner_user_id
+        for _ in contacts
+        if _.partner_user_id
     }
-    week_contacts = [
-        _ for _ in await context.db.read_contacts()
-        if _.week_index == context.schedule.current_week_index()
-    ]
+    users = await context.db.get_users(user_ids, fields=fields)
+    return {_.user_id: _ for _ in users if _}
+
+
+async def send_contacts(context):
+    week_contacts = await context.db.read_week_contacts(
+        context.schedule.current_week_index(),
+        fields=CONTACT_KEY_FIELDS
+    )
+    id_users = await get_partner_users(context, week_contacts)
 
     for contact in week_contacts:
         if contact.partner_user_id:
@@ -238,14 +387,14 @@ def ask_feedback_markup(context, partner_user):
 
 
 async def ask_feedback(context):
-    id_users = {
-        _.user_id: _
-        for _ in await context.db.read_users()
-    }
-    week_contacts = [
-        _ for _ in await context.db.read_contacts()
-        if _.week_index == context.schedule.current_week_index()
-    ]
+    week_contacts = await context.db.read_week_contacts(
+        context.schedule.current_week_index(),
+        fields=CONTACT_KEY_FIELDS
+    )
+    id_users = await get_partner_users(
+        context, week_contacts,
+        fields=USER_MENTION_FIELDS
+    )
 
     for contact in week_contacts:
         if not contact.partner_user_id:
@@ -313,7 +462,7 @@ def manual_match_markup(users):
 
 
 async def manual_match(context):
-    users = await context.db.read_users()
+    users = await context.db.read_users(fields=USER_PARTICIPATE_FIELDS)
     current_week_index = context.schedule.current_week_index()
 
     users = [
@@ -327,6 +476,7 @@ async def manual_match(context):
         )
     ]
     users = sorted(users, key=lambda _: _.created)
+    users = await context.db.get_users(_.user_id for _ in users)
 
     for text in manual_match_profile_texts(users):
         await context.bot.send_message(
@@ -349,14 +499,17 @@ async def manual_match(context):
 
 
 async def send_reports(context):
-    id_users = {
-        _.user_id: _
-        for _ in await context.db.read_users()
-    }
-    contacts = await context.db.read_contacts()
+    contacts = await read_contacts_history(context)
     manual_matches = await context.db.read_manual_matches()
     current_week_index = context.schedule.current_week_index()
 
+    user_ids = {
+        _.user_id for _ in contacts
+        if _.week_index >= current_week_index - 1
+    }
+    users = await context.db.get_users(user_ids, fields=USER_MENTION_FIELDS)
+    id_users = {_.user_id: _ for _ in users if _}
+
     records = gen_weeks_report(contacts)
     lines = format_weeks_report(records)
     text = report_text(lines, html=True)
@@ -0,0 +1,93 @@
+
+# aiogram FSM storage on top of chats table, state and data in one
+# Chat item. Bot works in private chats only, chat id = user id, key
+# by chat. Reads go through db chat cache, update loads item once.
+# Writes go through db session, all set_state/set_data of handlers
+# are flushed with one put after update is processed, see
+# Dispatcher.process_update
+#
+# Chat without state and data is deleted, not stored empty. Item
+# carries Chat.expires, Dynamo TTL removes abandoned flows. TTL
+# deletes lazily, expired item is treated as missing. Write is
+# skipped if state and data are not changed
+
+
+from time import time
+from dataclasses import replace
+from json import (
+    loads as parse_json,
+    dumps as format_json
+)
+
+from aiogram.dispatcher.storage import BaseStorage
+
+from neludim.const import CHAT_STATE_TTL
+from neludim.obj import Chat
+
+
+def parse_chat_data(data):
+    if data:
+        return parse_json(data)
+    return {}
+
+
+def format_chat_data(data):
+    if data:
+        return format_json(data, ensure_ascii=False)
+
+
+class ChatStorage(BaseStorage):
+    def __init__(self, db, ttl=CHAT_STATE_TTL, timer=time):
+        self.db = db
+        self.ttl = ttl
+        self.timer = timer
+
+    async def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    async def get_chat(self, chat, user):
+        id, _ = self.check_address(chat=chat, user=user)
+        chat = await self.db.get_chat(id)
+        if not chat or (chat.expires and chat.expires < self.timer()):
+            chat = Chat(id)
+        return chat
+
+    async def update_chat(self, chat, user, **fields):
+        chat = await self.get_chat(chat, user)
+        update = replace(chat, **fields)
+        if update == chat:
+            return
+
+        if not update.state and not update.data:
+            await self.db.delete_chat(chat.id)
+        else:
+            update.expires = int(self.timer() + self.ttl)
+            await self.db.put_chat(update)
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        chat = await self.get_chat(chat, user)
+        return chat.state or default
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        chat = await self.get_chat(chat, user)
+        return parse_chat_data(chat.data) or dict(default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await self.update_chat(chat, user, state=state)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await self.update_chat(chat, user, data=format_chat_data(data))
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        chat_data = await self.get_data(chat=chat, user=user)
+        chat_data.update(data or {}, **kwargs)
+        await self.set_data(chat=chat, user=user, data=chat_data)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        fields = {'state': None}
+        if with_data:
+            fields['data'] = None
+        await self.update_chat(chat, user, **fields)
@@ -4,6 +4,10 @@ from functools import partial
 from aiogram import executor
 
 from neludim.const import PORT
+from neludim.log import (
+    log,
+    json_msg
+)
 
 
 async def on_startup(context, _):
@@ -11,6 +15,7 @@ async def on_startup(context, _):
 
 
 async def on_shutdown(context, _):
+    log.info(json_msg(cache=context.db.cache_stats()))
     await context.db.close()
 
 
@@ -0,0 +1,61 @@
+# Bounded in-process LRU with TTL. Container lives minutes to hours,
+# several containers may serve the bot at once, TTL bounds staleness
+# of value written by other container. None is valid value, use
+# MISSING to tell "no entry" from "cached None". ttl <= 0 = off, set
+# stores nothing
+
+
+from time import monotonic
+from collections import OrderedDict
+
+
+MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize, ttl, timer=monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=MISSING):
+        entry = self.items.get(key)
+        if entry:
+            expires, value = entry
+            if expires > self.timer():
+                self.items.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.items[key]
+
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+
+        self.items[key] = (self.timer() + self.ttl, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def pop(self, key):
+        self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.items),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -1,6 +1,8 @@
 
 import sys
+import asyncio
 import argparse
+from functools import partial
 
 from .context import Context
 
@@ -19,7 +21,49 @@ def trigger_webhook(context, args):
     start_webhook(context)
 
 
+async def run_db_op(context, op):
+    await context.db.connect()
+    try:
+        await op(context)
+    finally:
+        await context.db.close()
+
+
+def migrate_contacts(context, args):
+    from .migrate import migrate_contacts
+
+    asyncio.run(run_db_op(context, migrate_contacts))
+
+
+def migrate_chat_expires(context, args):
+    from .migrate import migrate_chat_expires
+
+    asyncio.run(run_db_op(context, migrate_chat_expires))
+
+
+def backfill_pair_history(context, args):
+    from .bot.ops import backfill_pair_history
+
+    asyncio.run(run_db_op(context, backfill_pair_history))
+
+
+def export_snapshot(context, args):
+    from .snapshot import export_snapshot
+
+    op = partial(export_snapshot, dir=args.dir, tables=args.tables)
+    asyncio.run(run_db_op(context, op))
+
+
+def import_snapshot(context, args):
+    from .snapshot import import_snapshot
+
+    op = partial(import_snapshot, dir=args.dir, tables=args.tables)
+    asyncio.run(run_db_op(context, op))
+
+
 def build_parser():
+    from .snapshot import SNAPSHOT_TABLES
+
     parser = argparse.ArgumentParser(prog='neludim')
     parser.set_defaults(function=None)
     subs = parser.add_subparsers()
@@ -30,6 +74,25 @@ def build_parser():
     sub = subs.add_parser('trigger-webhook')
     sub.set_defaults(function=trigger_webhook)
 
+    sub = subs.add_parser('migrate-contacts')
+    sub.set_defaults(function=migrate_contacts)
+
+    sub = subs.add_parser('migrate-chat-expires')
+    sub.set_defaults(function=migrate_chat_expires)
+
+    sub = subs.add_parser('backfill-pair-history')
+    sub.set_defaults(function=backfill_pair_history)
+
+    for name, function in [('export', export_snapshot), ('import', import_snapshot)]:
+        sub = subs.add_parser(name)
+        sub.set_defaults(function=function)
+        sub.add_argument('dir')
+        sub.add_argument(
+            '--tables', nargs='+',
+            choices=SNAPSHOT_TABLES,
+            default=SNAPSHOT_TABLES
+        )
+
     return parser
 
 
@@ -61,28 +61,132 @@ WEEKDAYS = [
 #  DYNAMO
 ####
 
+READ = 'read'
+WRITE = 'write'
+
+B = 'B'
 BOOL = 'BOOL'
 N = 'N'
 S = 'S'
 M = 'M'
 SS = 'SS'
 
+# Client, see dynamo.dynamo_config
+DYNAMO_MAX_POOL_CONNECTIONS = int(getenv('DYNAMO_MAX_POOL_CONNECTIONS', 32))
+DYNAMO_KEEPALIVE_TIMEOUT = float(getenv('DYNAMO_KEEPALIVE_TIMEOUT', 60))
+DYNAMO_CONNECT_TIMEOUT = float(getenv('DYNAMO_CONNECT_TIMEOUT', 2))
+DYNAMO_READ_TIMEOUT = float(getenv('DYNAMO_READ_TIMEOUT', 10))
+DYNAMO_RETRY_MODE = getenv('DYNAMO_RETRY_MODE', 'standard')
+DYNAMO_RETRY_ATTEMPTS = int(getenv('DYNAMO_RETRY_ATTEMPTS', 3))
+
+# Connections to open on startup with DescribeTable, 0 = no warmup
+DYNAMO_WARMUP_CONNECTIONS = int(getenv('DYNAMO_WARMUP_CONNECTIONS', 4))
+
+# Client side rate limit, capacity units per second per table, 0 = no
+# limit. See neludim.throttle
+DYNAMO_READ_RATE = float(getenv('DYNAMO_READ_RATE', 1000))
+DYNAMO_WRITE_RATE = float(getenv('DYNAMO_WRITE_RATE', 500))
+
+# Share of bucket bulk ops leave for interactive calls, rate step up on
+# success as share of max rate
+DYNAMO_THROTTLE_RESERVE = 0.2
+DYNAMO_THROTTLE_STEP = 0.05
+
+# Parallel scan, number of Segment/TotalSegments requests in flight
+DYNAMO_SCAN_SEGMENTS = int(getenv('DYNAMO_SCAN_SEGMENTS', 4))
+
+# Batch writes, number of 25 item batch_write_item calls in flight
+DYNAMO_BATCH_CONCURRENCY = int(getenv('DYNAMO_BATCH_CONCURRENCY', 8))
+
+# Resubmit UnprocessedItems/Keys, retry canceled transactions with
+# exponential backoff, seconds. Throttling errors are retried by
+# botocore only, DYNAMO_RETRY_ATTEMPTS, see neludim.dynamo
+DYNAMO_BATCH_ATTEMPTS = 8
+DYNAMO_BACKOFF_BASE = 0.05
+DYNAMO_BACKOFF_CAP = 5
+
+# https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_TransactWriteItems.html
+# AWS allows 100 items per transaction, YDB docapi is stricter, keep
+# old AWS limit
+DYNAMO_TRANSACT_MAX_ITEMS = 25
+
+# Dynamo part of db bench is opt in, writes to own table with prefix,
+# never to bot tables, see neludim.bench
+BENCH_DYNAMO = getenv('BENCH_DYNAMO') == '1'
+BENCH_TABLE_PREFIX = getenv('BENCH_TABLE_PREFIX', 'bench_')
+
 ######
 #  DB
 #####
 
+DYNAMO_BACKEND = 'dynamo'
+SQLITE_BACKEND = 'sqlite'
+
+# sqlite for local runs, see neludim.sqlite
+DB_BACKEND = getenv('DB_BACKEND', DYNAMO_BACKEND)
+SQLITE_PATH = getenv('SQLITE_PATH', 'neludim.db')
+
 CHATS_TABLE = 'chats'
 CHATS_KEY = 'id'
 
 USERS_TABLE = 'users'
 USERS_KEY = 'user_id'
 
-CONTACTS_TABLE = 'contacts'
+CONTACTS_TABLE = 'week_contacts'
+CONTACTS_WEEK_KEY = 'week_index'
 CONTACTS_KEY = 'key'
 
+# Before week partitions, single key week_index#user_id#partner_user_id,
+# see neludim.migrate
+LEGACY_CONTACTS_TABLE = 'contacts'
+LEGACY_CONTACTS_KEY = 'key'
+
+# Weeks older than CONTACTS_HOT_WEEKS are moved from contacts table to
+# archive, one compact item per week, see archive_contacts
+CONTACTS_ARCHIVE_TABLE = 'contacts_archive'
+CONTACTS_ARCHIVE_KEY = 'week_index'
+CONTACTS_HOT_WEEKS = int(getenv('CONTACTS_HOT_WEEKS', 26))
+
 MANUAL_MATCHES_TABLE = 'manual_matches'
 MANUAL_MATCHES_KEY = 'key'
 
+# Contacts history aggregated per pair, key user_id#partner_user_id,
+# user_id < partner_user_id. Matching reads it instead of all contacts,
+# see neludim.history
+PAIR_HISTORY_TABLE = 'pair_history'
+PAIR_HISTORY_KEY = 'key'
+
+# Chat state routes every message, cache in process, see neludim.cache.
+# Other container may change state, cached state would route next
+# message wrong. 0 = off, enable only if bot is pinned to one instance
+CHAT_STATE_CACHE_SIZE = int(getenv('CHAT_STATE_CACHE_SIZE', 10000))
+CHAT_STATE_CACHE_TTL = float(getenv('CHAT_STATE_CACHE_TTL', 0))
+
+# Same for user profiles, see get_user. Other container may change
+# profile, cached one is stale up to TTL. 0 = off
+USER_CACHE_SIZE = int(getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(getenv('USER_CACHE_TTL', 0))
+
+# Abandoned edit/feedback flows expire, table has Dynamo TTL on
+# Chat.expires, see README
+CHAT_STATE_TTL = int(getenv('CHAT_STATE_TTL', 7 * 24 * 60 * 60))
+
+# Markers of resumable multi step ops, see commit_contacts
+PROGRESS_TABLE = 'progress'
+PROGRESS_KEY = 'key'
+
+# Projections. Partial reads return dataclasses with other fields set
+# to None, key fields are always fetched
+
+USER_KEY_FIELDS = ['user_id']
+CONTACT_KEY_FIELDS = ['week_index', 'user_id', 'partner_user_id']
+
+USER_MENTION_FIELDS = ['username', 'name']
+USER_PARTICIPATE_FIELDS = ['created', 'agreed_participate']
+USER_PARTNER_FIELDS = ['agreed_participate', 'partner_user_id']
+USER_MATCH_FIELDS = ['city', 'links', 'about']
+CONTACT_STATS_FIELDS = ['state', 'feedback_score']
+
 #####
 #  COMMAND
 #######
@@ -135,6 +239,24 @@ GREAT_SCORE = 'great'
 OK_SCORE = 'ok'
 BAD_SCORE = 'bad'
 
+######
+#  MATCH
+#####
+
+# See neludim.match. Auto = exact up to MATCH_EXACT_MAX_USERS, greedy
+# above. Exact is ~O(N^3), 300 users ~6s, 500 ~20s, trigger has 60s.
+# Greedy by default until exact is checked on real weeks
+GREEDY_MATCH_ENGINE = 'greedy'
+EXACT_MATCH_ENGINE = 'exact'
+AUTO_MATCH_ENGINE = 'auto'
+MATCH_ENGINE = getenv('MATCH_ENGINE', GREEDY_MATCH_ENGINE)
+MATCH_EXACT_MAX_USERS = int(getenv('MATCH_EXACT_MAX_USERS', 300))
+
+# Greedy rounds, best is selected. Workers > 0 = run rounds in process
+# pool
+MATCH_ROUNDS = int(getenv('MATCH_ROUNDS', 10))
+MATCH_WORKERS = int(getenv('MATCH_WORKERS', 0))
+
 ######
 #  PORT
 #####
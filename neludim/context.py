@@ -4,14 +4,30 @@ from .bot.bot import (
     Dispatcher
 )
 from .bot.broadcast import Broadcast
+from .bot.storage import ChatStorage
 from .db import DB
+from .sqlite import SqliteDB
 from .schedule import Schedule
+from .const import (
+    DB_BACKEND,
+    SQLITE_BACKEND,
+    SQLITE_PATH,
+)
+
+
+def init_db(backend=DB_BACKEND):
+    if backend == SQLITE_BACKEND:
+        return SqliteDB(SQLITE_PATH)
+    return DB()
 
 
 class Context:
     def __init__(self):
         self.bot = init_bot()
-        self.dispatcher = Dispatcher(self.bot)
+        self.db = init_db()
+        self.dispatcher = Dispatcher(
+            self.bot,
+            storage=ChatStorage(self.db)
+        )
         self.broadcast = Broadcast(self.bot)
-        self.db = DB()
         self.schedule = Schedule()
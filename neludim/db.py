@@ -1,9 +1,26 @@
+import gzip
+import asyncio
+from json import (
+    loads as parse_json,
+    dumps as format_json
+)
+from dataclasses import asdict
+from contextvars import ContextVar
+from contextlib import asynccontextmanager
+from functools import partial
+from collections import defaultdict
 
 from .obj import (
     Chat,
     Contact,
     User,
     Match,
+    Progress,
+)
+from .history import (
+    PAIR_SIDE_PREFIX,
+    parse_pair_history,
+    merge_pair_histories,
 )
 from .const import (
     CHATS_TABLE,
@@ -13,61 +30,499 @@ from .const import (
     USERS_KEY,
 
     CONTACTS_TABLE,
+    CONTACTS_WEEK_KEY,
     CONTACTS_KEY,
 
+    CONTACTS_ARCHIVE_TABLE,
+    CONTACTS_ARCHIVE_KEY,
+
     MANUAL_MATCHES_TABLE,
     MANUAL_MATCHES_KEY,
 
-    N, S,
+    PAIR_HISTORY_TABLE,
+    PAIR_HISTORY_KEY,
+
+    PROGRESS_TABLE,
+    PROGRESS_KEY,
+
+    USER_KEY_FIELDS,
+    CONTACT_KEY_FIELDS,
+
+    DYNAMO_SCAN_SEGMENTS,
+    DYNAMO_BATCH_CONCURRENCY,
+    DYNAMO_WARMUP_CONNECTIONS,
+    DYNAMO_READ_RATE,
+    DYNAMO_WRITE_RATE,
+    DYNAMO_TRANSACT_MAX_ITEMS,
+
+    CHAT_STATE_CACHE_SIZE,
+    CHAT_STATE_CACHE_TTL,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+
+    READ, WRITE,
+    N, S, B, M,
 )
 from .dynamo import (
     dynamo_client,
+    dynamo_warmup,
 
+    dynamo_key_id,
     dynamo_get,
-    dynamo_scan,
+    dynamo_put,
+    dynamo_update,
+    dynamo_batch_get,
+    dynamo_scan_pages,
+    dynamo_query_pages,
+    dynamo_batch_write,
     dynamo_batch_delete,
     dynamo_batch_put,
+    dynamo_transact_put,
+    dynamo_transact_update,
+    dynamo_transact_write,
 
-    dynamo_deserialize_item,
-    dynamo_serialize_item,
+    dynamo_decode_item,
+    dynamo_encode_item,
+    dynamo_encode_fields,
     dynamo_serialize_key,
 )
+from .throttle import Throttle
+from .cache import (
+    TTLCache,
+    MISSING
+)
+from .log import (
+    log,
+    json_msg
+)
 
 
 #######
 #
-#   CHATS
+#   KEY/PROJECTION
+#
+######
+
+
+def chat_key(id):
+    return {CHATS_KEY: {N: str(id)}}
+
+
+def user_key(user_id):
+    return {USERS_KEY: {N: str(user_id)}}
+
+
+# Contacts partitioned by week, week ops query one partition. Sort key
+# user_id#partner_user_id or user_id if no partner
+
+
+def contact_key(key):
+    week_index, *user_ids = key
+    return {
+        CONTACTS_WEEK_KEY: {N: str(week_index)},
+        CONTACTS_KEY: {S: dynamo_serialize_key(user_ids)}
+    }
+
+
+def manual_match_key(key):
+    return {MANUAL_MATCHES_KEY: {S: dynamo_serialize_key(key)}}
+
+
+def pair_history_key(key):
+    return {PAIR_HISTORY_KEY: {S: dynamo_serialize_key(key)}}
+
+
+def progress_key(key):
+    return {PROGRESS_KEY: {S: key}}
+
+
+def projection_fields(fields, key_fields):
+    if fields:
+        return list(dict.fromkeys([*key_fields, *fields]))
+
+
+#######
 #
+#   THROTTLE
+#
+######
+
+
+# Separate bucket per table and kind, tables have own capacity. Rate
+# 0 = no client side limit
+
+
+def db_throttle(db, table, kind):
+    rate = db.read_rate if kind == READ else db.write_rate
+    if not rate:
+        return
+
+    key = (table, kind)
+    if key not in db.throttles:
+        db.throttles[key] = Throttle(rate)
+    return db.throttles[key]
+
+
 #######
+#
+#   SESSION
+#
+######
 
 
-async def get_chat(db, id):
+# Unit of work. Inside db.session() puts and deletes are buffered per
+# key, later write to the same key replaces earlier one. On exit
+# buffer is flushed with batch writes, one per table, in parallel.
+# Reads inside session see buffered writes. Nested session joins
+# outer one. Updates return new item, conditional, not buffered,
+# unless item is already in buffer
+#
+# Session is also identity map: full item reads by key are remembered,
+# missing items too, same key is fetched once per session. Partial
+# reads are served from remembered item, not remembered themselves
+#
+# Writes left unprocessed after retries raise SessionFlushError on
+# exit, update or trigger task fails instead of losing writes
+# silently. If body raised, buffered writes are dropped, not flushed
+# half done, error is passed on as is
+#
+# In process caches must not see writes that are not stored, cache
+# set is deferred with after_flush, runs only if flush succeeded
+
+SESSION = ContextVar('db_session', default=None)
+
+
+class SessionFlushError(Exception):
+    pass
+
+
+class Session:
+    def __init__(self):
+        self.writes = {}
+        self.reads = {}
+        self.flushed = []
+
+    def put(self, table, key, item):
+        self.writes[table, dynamo_key_id(key)] = (key, item)
+
+    def delete(self, table, key):
+        self.writes[table, dynamo_key_id(key)] = (key, None)
+
+    def remember(self, table, key, item):
+        self.reads[table, dynamo_key_id(key)] = (key, item)
+
+    def lookup_write(self, table, key):
+        return self.writes.get((table, dynamo_key_id(key)))
+
+    def lookup(self, table, key):
+        return (
+            self.lookup_write(table, key)
+            or self.reads.get((table, dynamo_key_id(key)))
+        )
+
+    def table_items(self, table):
+        return {
+            key_id: item
+            for (write_table, key_id), (_, item) in self.writes.items()
+            if write_table == table
+        }
+
+
+def after_flush(callback):
+    session = SESSION.get()
+    if session:
+        session.flushed.append(callback)
+    else:
+        callback()
+
+
+def write_request(key, item):
+    if item is None:
+        return {'DeleteRequest': {'Key': key}}
+    return {'PutRequest': {'Item': item}}
+
+
+async def flush_session(db, session):
+    table_requests = defaultdict(list)
+    for (table, _), (key, item) in session.writes.items():
+        table_requests[table].append(write_request(key, item))
+    session.writes = {}
+
+    failed = await asyncio.gather(*(
+        dynamo_batch_write(
+            db.client, table, requests,
+            concurrency=db.batch_concurrency,
+            throttle=db_throttle(db, table, WRITE)
+        )
+        for table, requests in table_requests.items()
+    ))
+    return sum(failed)
+
+
+@asynccontextmanager
+async def session(db):
+    current = SESSION.get()
+    if current:
+        yield current
+        return
+
+    current = Session()
+    token = SESSION.set(current)
+    try:
+        yield current
+    finally:
+        SESSION.reset(token)
+
+    failed = await flush_session(db, current)
+    if failed:
+        log.info(json_msg(session_failed=failed))
+        raise SessionFlushError(f'{failed} writes failed')
+
+    for callback in current.flushed:
+        callback()
+
+
+#######
+#
+#   OPS
+#
+######
+
+
+# Items for put always have key attributes, see serialize_contact,
+# serialize_manual_match, serialize_pair_history
+
+TABLE_KEYS = {
+    CHATS_TABLE: [CHATS_KEY],
+    USERS_TABLE: [USERS_KEY],
+    CONTACTS_TABLE: [CONTACTS_WEEK_KEY, CONTACTS_KEY],
+    MANUAL_MATCHES_TABLE: [MANUAL_MATCHES_KEY],
+    PAIR_HISTORY_TABLE: [PAIR_HISTORY_KEY],
+    PROGRESS_TABLE: [PROGRESS_KEY],
+    CONTACTS_ARCHIVE_TABLE: [CONTACTS_ARCHIVE_KEY],
+}
+
+
+def item_key(table, item):
+    return {
+        _: item[_]
+        for _ in TABLE_KEYS[table]
+    }
+
+
+def project_item(item, fields=None):
+    if item and fields:
+        return {
+            _: item[_]
+            for _ in fields
+            if _ in item
+        }
+    return item
+
+
+async def db_get(db, table, key, fields=None):
+    session = SESSION.get()
+    if session:
+        write = session.lookup(table, key)
+        if write:
+            _, item = write
+            return project_item(item, fields)
+
     item = await dynamo_get(
-        db.client, CHATS_TABLE,
-        CHATS_KEY, N, id
+        db.client, table, key,
+        fields=fields,
+        throttle=db_throttle(db, table, READ)
+    )
+    if session and not fields:
+        session.remember(table, key, item)
+    return item
+
+
+async def db_batch_get(db, table, keys, fields=None):
+    items = []
+    session = SESSION.get()
+    if session:
+        missing = []
+        for key in keys:
+            write = session.lookup(table, key)
+            if not write:
+                missing.append(key)
+            elif write[1]:
+                items.append(project_item(write[1], fields))
+        keys = missing
+
+    fetched = await dynamo_batch_get(
+        db.client, table, keys,
+        fields=fields,
+        concurrency=db.batch_concurrency,
+        throttle=db_throttle(db, table, READ)
+    )
+    if session and not fields:
+        for key in keys:
+            session.remember(table, key, None)
+        for item in fetched:
+            session.remember(table, item_key(table, item), item)
+
+    items.extend(fetched)
+    return items
+
+
+# Scan/query pages with buffered writes: stored item is skipped if key
+# is in buffer, buffered puts go in last page. Match selects buffered
+# items of queried partition
+
+
+async def session_pages(pages, table, fields=None, match=None):
+    session = SESSION.get()
+    buffer = session.table_items(table) if session else None
+    if not buffer:
+        async for items in pages:
+            yield items
+        return
+
+    async for items in pages:
+        yield [
+            _ for _ in items
+            if dynamo_key_id(item_key(table, _)) not in buffer
+        ]
+
+    yield [
+        project_item(_, fields)
+        for _ in buffer.values()
+        if _ and (not match or match(_))
+    ]
+
+
+def db_scan_pages(db, table, fields=None):
+    pages = dynamo_scan_pages(
+        db.client, table,
+        segments=db.scan_segments,
+        fields=fields,
+        throttle=db_throttle(db, table, READ)
+    )
+    return session_pages(pages, table, fields)
+
+
+def db_query_pages(db, table, key_name, key_type, key_value, fields=None):
+    pages = dynamo_query_pages(
+        db.client, table,
+        key_name, key_type, key_value,
+        fields=fields,
+        throttle=db_throttle(db, table, READ)
+    )
+    value = {key_type: str(key_value)}
+    return session_pages(
+        pages, table, fields,
+        match=lambda item: item.get(key_name) == value
+    )
+
+
+async def db_update(db, table, key, attrs):
+    session = SESSION.get()
+    if session:
+        # Remembered read is not buffered, update stays conditional
+        write = session.lookup_write(table, key)
+        if write:
+            key, item = write
+            if item is None:
+                return
+
+            item = dict(item)
+            for name, value in attrs.items():
+                if value is None:
+                    item.pop(name, None)
+                else:
+                    item[name] = value
+            session.put(table, key, item)
+            return item
+
+    item = await dynamo_update(
+        db.client, table, key, attrs,
+        throttle=db_throttle(db, table, WRITE)
+    )
+    if session:
+        session.remember(table, key, item)
+    return item
+
+
+async def db_batch_put(db, table, items):
+    session = SESSION.get()
+    if session:
+        for item in items:
+            session.put(table, item_key(table, item), item)
+        return 0
+
+    return await dynamo_batch_put(
+        db.client, table, items,
+        concurrency=db.batch_concurrency,
+        throttle=db_throttle(db, table, WRITE)
+    )
+
+
+async def db_batch_delete(db, table, keys):
+    session = SESSION.get()
+    if session:
+        for key in keys:
+            session.delete(table, key)
+        return 0
+
+    return await dynamo_batch_delete(
+        db.client, table, keys,
+        concurrency=db.batch_concurrency,
+        throttle=db_throttle(db, table, WRITE)
     )
+
+
+#######
+#
+#   CHATS
+#
+#######
+
+
+# Every message is routed by chat state, see neludim.bot.storage.
+# State set by other container must be seen on next message: no
+# negative entries, cache is off by default, see CHAT_STATE_CACHE_TTL.
+# Within update chat is read once anyway, session remembers read, see
+# db_get. Cache is set after write is stored, see after_flush
+
+
+async def get_chat(db, id):
+    chat = db.chat_state_cache.get(id)
+    if chat is not MISSING:
+        return chat
+
+    item = await db_get(db, CHATS_TABLE, chat_key(id))
     if item:
-        return dynamo_deserialize_item(item, Chat)
+        chat = dynamo_decode_item(item, Chat)
+        after_flush(partial(db.chat_state_cache.set, id, chat))
+        return chat
 
 
-async def put_chat(db, chat):
-    item = dynamo_serialize_item(chat)
-    await dynamo_batch_put(db.client, CHATS_TABLE, [item])
+async def iter_chats(db):
+    async for items in db_scan_pages(db, CHATS_TABLE):
+        for item in items:
+            yield dynamo_decode_item(item, Chat)
 
 
-async def get_chat_state(db, id):
-    chat = await get_chat(db, id)
-    if chat:
-        return chat.state
+async def put_chats(db, chats):
+    chats = list(chats)
+    items = [dynamo_encode_item(_) for _ in chats]
+    failed = await db_batch_put(db, CHATS_TABLE, items)
+    for chat in chats:
+        db.chat_state_cache.pop(chat.id)
+        if not failed:
+            after_flush(partial(db.chat_state_cache.set, chat.id, chat))
+    return failed
 
 
-async def set_chat_state(db, id, state):
-    chat = Chat(id, state)
-    await put_chat(db, chat)
+async def put_chat(db, chat):
+    await put_chats(db, [chat])
 
 
-async def reset_chat_state(db, id):
-    await set_chat_state(db, id, state=None)
+async def delete_chat(db, id):
+    db.chat_state_cache.pop(id)
+    await db_batch_delete(db, CHATS_TABLE, [chat_key(id)])
 
 
 ######
@@ -77,29 +532,100 @@ async def reset_chat_state(db, id):
 #######
 
 
-async def get_user(db, user_id):
-    item = await dynamo_get(
-        db.client, USERS_TABLE,
-        USERS_KEY, N, user_id
-    )
+# Profile is read on almost every callback, cache full items in
+# process. Partial reads are served from cached full item, but never
+# cached. Entry is dropped at once on write, new item is cached after
+# write is stored, see after_flush. Item is decoded on every hit,
+# callers may mutate User. Off by default, see USER_CACHE_TTL
+
+
+def cache_user_item(db, user_id, item):
+    db.user_cache.pop(user_id)
     if item:
-        return dynamo_deserialize_item(item, User)
+        after_flush(partial(db.user_cache.set, user_id, item))
+
 
+def decode_user_item(item, fields=None):
+    item = project_item(item, projection_fields(fields, USER_KEY_FIELDS))
+    return dynamo_decode_item(item, User)
 
-async def read_users(db):
-    items = await dynamo_scan(db.client, USERS_TABLE)
-    return [dynamo_deserialize_item(_, User) for _ in items]
+
+async def get_user(db, user_id, fields=None):
+    item = db.user_cache.get(user_id)
+    if item is MISSING:
+        item = await db_get(
+            db, USERS_TABLE,
+            user_key(user_id),
+            fields=projection_fields(fields, USER_KEY_FIELDS)
+        )
+        if not fields:
+            cache_user_item(db, user_id, item)
+
+    if item:
+        return decode_user_item(item, fields)
+
+
+async def get_users(db, user_ids, fields=None):
+    user_ids = list(user_ids)
+
+    id_items = {}
+    for user_id in user_ids:
+        item = db.user_cache.get(user_id)
+        if item is not MISSING:
+            id_items[user_id] = item
+
+    missing_ids = [_ for _ in user_ids if _ not in id_items]
+    if missing_ids:
+        items = await db_batch_get(
+            db, USERS_TABLE,
+            [user_key(_) for _ in missing_ids],
+            fields=projection_fields(fields, USER_KEY_FIELDS)
+        )
+        for item in items:
+            user_id = int(item[USERS_KEY][N])
+            id_items[user_id] = item
+            if not fields:
+                cache_user_item(db, user_id, item)
+
+    return [
+        decode_user_item(id_items[_], fields)
+        if _ in id_items else None
+        for _ in user_ids
+    ]
+
+
+async def iter_users(db, filter=None, fields=None):
+    pages = db_scan_pages(
+        db, USERS_TABLE,
+        fields=projection_fields(fields, USER_KEY_FIELDS)
+    )
+    async for items in pages:
+        for item in items:
+            user = dynamo_decode_item(item, User)
+            if not filter or filter(user):
+                yield user
+
+
+async def read_users(db, fields=None):
+    return [_ async for _ in iter_users(db, fields=fields)]
 
 
 async def put_users(db, users):
-    items = (dynamo_serialize_item(_) for _ in users)
-    await dynamo_batch_put(db.client, USERS_TABLE, items)
+    users = list(users)
+    items = [dynamo_encode_item(_) for _ in users]
+    failed = await db_batch_put(db, USERS_TABLE, items)
+    for user, item in zip(users, items):
+        cache_user_item(db, user.user_id, None if failed else item)
+    return failed
 
 
 async def delete_users(db, user_ids):
-    await dynamo_batch_delete(
-        db.client, USERS_TABLE,
-        USERS_KEY, N, user_ids
+    user_ids = list(user_ids)
+    for user_id in user_ids:
+        cache_user_item(db, user_id, None)
+    return await db_batch_delete(
+        db, USERS_TABLE,
+        [user_key(_) for _ in user_ids]
     )
 
 
@@ -107,6 +633,30 @@ async def put_user(db, user):
     await put_users(db, [user])
 
 
+async def update_user(db, user_id, **fields):
+    item = await db_update(
+        db, USERS_TABLE,
+        user_key(user_id),
+        dynamo_encode_fields(User, fields)
+    )
+    cache_user_item(db, user_id, item)
+    if item:
+        return dynamo_decode_item(item, User)
+
+
+async def update_users(db, user_id_fields):
+    semaphore = asyncio.Semaphore(db.batch_concurrency)
+
+    async def update(user_id, fields):
+        async with semaphore:
+            return await update_user(db, user_id, **fields)
+
+    return await asyncio.gather(*(
+        update(user_id, fields)
+        for user_id, fields in user_id_fields
+    ))
+
+
 async def delete_user(db, user_id):
     await delete_users(db, [user_id])
 
@@ -118,36 +668,86 @@ async def delete_user(db, user_id):
 #####
 
 
-async def get_contact(db, key):
-    item = await dynamo_get(
-        db.client, CONTACTS_TABLE,
-        CONTACTS_KEY, S, dynamo_serialize_key(key)
+# Sort key attribute is not a Contact field, project it too, scan
+# inside session matches stored items with buffered by key
+
+def contact_projection_fields(fields):
+    return projection_fields(fields, [CONTACTS_KEY, *CONTACT_KEY_FIELDS])
+
+
+async def get_contact(db, key, fields=None):
+    item = await db_get(
+        db, CONTACTS_TABLE,
+        contact_key(key),
+        fields=contact_projection_fields(fields)
     )
     if item:
-        return dynamo_deserialize_item(item, Contact)
+        return dynamo_decode_item(item, Contact)
+
+
+async def get_contacts(db, keys, fields=None):
+    keys = list(keys)
+    items = await db_batch_get(
+        db, CONTACTS_TABLE,
+        [contact_key(_) for _ in keys],
+        fields=contact_projection_fields(fields)
+    )
+    key_contacts = {}
+    for item in items:
+        contact = dynamo_decode_item(item, Contact)
+        key_contacts[contact.key] = contact
+    return [key_contacts.get(tuple(_)) for _ in keys]
+
+
+async def iter_contacts(db, filter=None, fields=None):
+    pages = db_scan_pages(
+        db, CONTACTS_TABLE,
+        fields=contact_projection_fields(fields)
+    )
+    async for items in pages:
+        for item in items:
+            contact = dynamo_decode_item(item, Contact)
+            if not filter or filter(contact):
+                yield contact
+
+
+async def read_contacts(db, fields=None):
+    return [_ async for _ in iter_contacts(db, fields=fields)]
+
+
+async def iter_week_contacts(db, week_index, fields=None):
+    pages = db_query_pages(
+        db, CONTACTS_TABLE,
+        CONTACTS_WEEK_KEY, N, week_index,
+        fields=contact_projection_fields(fields)
+    )
+    async for items in pages:
+        for item in items:
+            yield dynamo_decode_item(item, Contact)
 
 
-async def read_contacts(db):
-    items = await dynamo_scan(db.client, CONTACTS_TABLE)
-    return [dynamo_deserialize_item(_, Contact) for _ in items]
+async def read_week_contacts(db, week_index, fields=None):
+    return [
+        _ async for _ in
+        iter_week_contacts(db, week_index, fields=fields)
+    ]
 
 
 def serialize_contact(contact):
-    item = dynamo_serialize_item(contact)
-    item[CONTACTS_KEY] = {S: dynamo_serialize_key(contact.key)}
+    item = dynamo_encode_item(contact)
+    item.update(contact_key(contact.key))
     return item
 
 
 async def put_contacts(db, contacts):
-    items = (serialize_contact(_) for _ in contacts)
-    await dynamo_batch_put(db.client, CONTACTS_TABLE, items)
+    items = [serialize_contact(_) for _ in contacts]
+    return await db_batch_put(db, CONTACTS_TABLE, items)
 
 
 async def delete_contacts(db, keys):
-    keys = (dynamo_serialize_key(_) for _ in keys)
-    await dynamo_batch_delete(
-        db.client, CONTACTS_TABLE,
-        CONTACTS_KEY, S, keys
+    return await db_batch_delete(
+        db, CONTACTS_TABLE,
+        [contact_key(_) for _ in keys]
     )
 
 
@@ -155,10 +755,205 @@ async def put_contact(db, contact):
     await put_contacts(db, [contact])
 
 
+async def update_contact(db, key, **fields):
+    item = await db_update(
+        db, CONTACTS_TABLE,
+        contact_key(key),
+        dynamo_encode_fields(Contact, fields)
+    )
+    if item:
+        return dynamo_decode_item(item, Contact)
+
+
 async def delete_contact(db, key):
     await delete_contacts(db, [key])
 
 
+# Week contacts and users partner_user_id in TransactWriteItems chunks,
+# all or nothing per chunk. Group = contacts and partner ids of one
+# match, never split between chunks. Chunk also puts own progress item
+# {key}#{index} with attribute_not_exists condition. Same groups ->
+# same chunks, rerun skips chunks with progress item. Canceled on
+# progress condition = committed by concurrent run. Canceled on user
+# condition = user deleted since read, drop update, retry
+
+
+def contacts_chunks(groups, max_size):
+    chunk, size = [], 0
+    for contacts, user_partner_ids in groups:
+        group_size = len(contacts) + len(user_partner_ids)
+        if chunk and size + group_size > max_size:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append((contacts, user_partner_ids))
+        size += group_size
+    if chunk:
+        yield chunk
+
+
+def contacts_chunk_items(key, chunk):
+    items = []
+    for contacts, user_partner_ids in chunk:
+        for contact in contacts:
+            items.append(dynamo_transact_put(
+                CONTACTS_TABLE,
+                serialize_contact(contact)
+            ))
+        for user_id, partner_user_id in user_partner_ids.items():
+            items.append(dynamo_transact_update(
+                USERS_TABLE,
+                user_key(user_id),
+                dynamo_encode_fields(User, {'partner_user_id': partner_user_id})
+            ))
+
+    items.append(dynamo_transact_put(
+        PROGRESS_TABLE,
+        dynamo_encode_item(Progress(key)),
+        condition='attribute_not_exists(#k)',
+        names={'#k': PROGRESS_KEY}
+    ))
+    return items
+
+
+# Retries with backoff are in dynamo_transact_write. Here only items
+# with failed condition are dropped and rest is resubmitted, every
+# pass drops at least one item
+
+
+async def commit_contacts_chunk(db, items):
+    while True:
+        codes = await dynamo_transact_write(
+            db.client, items,
+            throttle=db_throttle(db, CONTACTS_TABLE, WRITE)
+        )
+        if codes is None:
+            return True
+        if not codes:
+            return False
+        if codes[-1] == 'ConditionalCheckFailed':
+            return True
+
+        failed = {
+            index for index, code in enumerate(codes)
+            if code == 'ConditionalCheckFailed'
+        }
+        if not failed:
+            return False
+        items = [
+            item for index, item in enumerate(items)
+            if index not in failed
+        ]
+
+
+async def commit_contacts(db, key, groups):
+    chunks = list(contacts_chunks(groups, DYNAMO_TRANSACT_MAX_ITEMS - 1))
+    chunk_keys = [f'{key}#{_}' for _ in range(len(chunks))]
+
+    items = await db_batch_get(
+        db, PROGRESS_TABLE,
+        [progress_key(_) for _ in chunk_keys]
+    )
+    committed = {
+        dynamo_decode_item(_, Progress).key
+        for _ in items
+    }
+
+    semaphore = asyncio.Semaphore(db.batch_concurrency)
+
+    async def commit(chunk_key, chunk):
+        # Transaction updates users bypassing update_user
+        for _, user_partner_ids in chunk:
+            for user_id in user_partner_ids:
+                cache_user_item(db, user_id, None)
+
+        async with semaphore:
+            items = contacts_chunk_items(chunk_key, chunk)
+            return await commit_contacts_chunk(db, items)
+
+    results = await asyncio.gather(
+        *(
+            commit(chunk_key, chunk)
+            for chunk_key, chunk in zip(chunk_keys, chunks)
+            if chunk_key not in committed
+        ),
+        return_exceptions=True
+    )
+
+    failed = 0
+    for result in results:
+        if result is not True:
+            failed += 1
+            if isinstance(result, Exception):
+                log.info(json_msg(key=key, error=str(result)))
+
+    log.info(json_msg(
+        key=key,
+        chunks=len(chunks),
+        skipped=len(committed),
+        failed=failed
+    ))
+    return failed
+
+
+#######
+#
+#   CONTACTS ARCHIVE
+#
+######
+
+
+# Item per week: week_index + gzipped JSON list of contacts without
+# None fields. ~100 contacts per week, ~2KB compressed, far from 400KB
+# item limit
+
+
+def format_archive_contacts(contacts):
+    rows = []
+    for contact in contacts:
+        row = asdict(contact)
+        row.pop('week_index')
+        rows.append({
+            name: value
+            for name, value in row.items()
+            if value is not None
+        })
+    data = format_json(rows, ensure_ascii=False)
+    return gzip.compress(data.encode('utf8'))
+
+
+def parse_archive_contacts(week_index, data):
+    rows = parse_json(gzip.decompress(data))
+    return [
+        Contact(week_index=week_index, **_)
+        for _ in rows
+    ]
+
+
+async def read_archive_contacts(db):
+    contacts = []
+    async for items in db_scan_pages(db, CONTACTS_ARCHIVE_TABLE):
+        for item in items:
+            week_index = int(item[CONTACTS_ARCHIVE_KEY][N])
+            data = item['contacts'][B]
+            contacts.extend(parse_archive_contacts(week_index, data))
+    return contacts
+
+
+# Not buffered in session, archive must be stored before hot contacts
+# are deleted
+
+
+async def put_archive_week(db, week_index, contacts):
+    item = {
+        CONTACTS_ARCHIVE_KEY: {N: str(week_index)},
+        'contacts': {B: format_archive_contacts(contacts)}
+    }
+    await dynamo_put(
+        db.client, CONTACTS_ARCHIVE_TABLE, item,
+        throttle=db_throttle(db, CONTACTS_ARCHIVE_TABLE, WRITE)
+    )
+
+
 #######
 #
 #    MANUAL MATCHES
@@ -166,27 +961,31 @@ async def delete_contact(db, key):
 ######
 
 
+async def iter_manual_matches(db):
+    async for items in db_scan_pages(db, MANUAL_MATCHES_TABLE):
+        for item in items:
+            yield dynamo_decode_item(item, Match)
+
+
 async def read_manual_matches(db):
-    items = await dynamo_scan(db.client, MANUAL_MATCHES_TABLE)
-    return [dynamo_deserialize_item(_, Match) for _ in items]
+    return [_ async for _ in iter_manual_matches(db)]
 
 
 def serialize_manual_match(match):
-    item = dynamo_serialize_item(match)
-    item[MANUAL_MATCHES_KEY] = {S: dynamo_serialize_key(match.key)}
+    item = dynamo_encode_item(match)
+    item.update(manual_match_key(match.key))
     return item
 
 
 async def put_manual_matches(db, matches):
-    items = (serialize_manual_match(_) for _ in matches)
-    await dynamo_batch_put(db.client, MANUAL_MATCHES_TABLE, items)
+    items = [serialize_manual_match(_) for _ in matches]
+    return await db_batch_put(db, MANUAL_MATCHES_TABLE, items)
 
 
 async def delete_manual_matches(db, keys):
-    keys = (dynamo_serialize_key(_) for _ in keys)
-    await dynamo_batch_delete(
-        db.client, MANUAL_MATCHES_TABLE,
-        MANUAL_MATCHES_KEY, S, keys
+    return await db_batch_delete(
+        db, MANUAL_MATCHES_TABLE,
+        [manual_match_key(_) for _ in keys]
     )
 
 
@@ -198,6 +997,148 @@ async def delete_manual_match(db, key):
     await delete_manual_matches(db, [key])
 
 
+#######
+#
+#    PAIR HISTORY
+#
+######
+
+
+# Not buffered in session, create_contacts marks week done after merge,
+# merge must be stored by then. Sides are M attributes of pair item,
+# see history.py. Item without sides, written before sides, is
+# skipped, backfill_pair_history fills it
+
+
+def encode_pair_side(state, feedback_score):
+    fields = {'state': state, 'feedback_score': feedback_score}
+    return {M: {
+        name: {S: value}
+        for name, value in fields.items()
+        if value is not None
+    }}
+
+
+def decode_pair_side(value):
+    fields = value[M]
+    return (
+        fields.get('state', {}).get(S),
+        fields.get('feedback_score', {}).get(S)
+    )
+
+
+def decode_pair_history(item):
+    key = (int(item['user_id'][N]), int(item['partner_user_id'][N]))
+    sides = {
+        name: decode_pair_side(value)
+        for name, value in item.items()
+        if name.startswith(PAIR_SIDE_PREFIX)
+    }
+    return parse_pair_history(key, sides)
+
+
+def pair_history_update_attrs(key, sides):
+    user_id, partner_user_id = key
+    attrs = {
+        'user_id': {N: str(user_id)},
+        'partner_user_id': {N: str(partner_user_id)},
+    }
+    for name, (state, feedback_score) in sides.items():
+        attrs[name] = encode_pair_side(state, feedback_score)
+    return attrs
+
+
+async def get_pair_histories(db, keys):
+    keys = list(keys)
+    items = await dynamo_batch_get(
+        db.client, PAIR_HISTORY_TABLE,
+        [pair_history_key(_) for _ in keys],
+        concurrency=db.batch_concurrency,
+        throttle=db_throttle(db, PAIR_HISTORY_TABLE, READ)
+    )
+    key_histories = {}
+    for item in items:
+        history = decode_pair_history(item)
+        if history:
+            key_histories[history.key] = history
+    return [key_histories.get(tuple(_)) for _ in keys]
+
+
+async def iter_pair_histories(db):
+    async for items in db_scan_pages(db, PAIR_HISTORY_TABLE):
+        for item in items:
+            history = decode_pair_history(item)
+            if history:
+                yield history
+
+
+async def read_pair_histories(db):
+    return [_ async for _ in iter_pair_histories(db)]
+
+
+# One UpdateItem per pair, sets only given sides, concurrent merges of
+# same pair do not overwrite each other. Returns number of failed pairs
+
+
+async def update_pair_sides(db, key_sides):
+    semaphore = asyncio.Semaphore(db.batch_concurrency)
+
+    async def update(key, sides):
+        async with semaphore:
+            await dynamo_update(
+                db.client, PAIR_HISTORY_TABLE,
+                pair_history_key(key),
+                pair_history_update_attrs(key, sides),
+                create=True,
+                throttle=db_throttle(db, PAIR_HISTORY_TABLE, WRITE)
+            )
+
+    results = await asyncio.gather(
+        *(update(key, sides) for key, sides in key_sides.items()),
+        return_exceptions=True
+    )
+
+    failed = 0
+    for key, result in zip(key_sides, results):
+        if isinstance(result, Exception):
+            failed += 1
+            log.info(json_msg(
+                table=PAIR_HISTORY_TABLE,
+                key=key,
+                error=str(result)
+            ))
+    return failed
+
+
+#######
+#
+#    PROGRESS
+#
+######
+
+
+# Not buffered in session, marker must be stored before steps it
+# guards
+
+
+async def get_progress(db, key):
+    item = await dynamo_get(
+        db.client, PROGRESS_TABLE,
+        progress_key(key),
+        throttle=db_throttle(db, PROGRESS_TABLE, READ)
+    )
+    if item:
+        return dynamo_decode_item(item, Progress)
+
+
+async def put_progress(db, progress):
+    await dynamo_put(
+        db.client, PROGRESS_TABLE,
+        dynamo_encode_item(progress),
+        throttle=db_throttle(db, PROGRESS_TABLE, WRITE)
+    )
+
+
 ######
 #
 #  DB
@@ -206,39 +1147,106 @@ async def delete_manual_match(db, key):
 
 
 class DB:
-    def __init__(self):
+    def __init__(
+            self,
+            scan_segments=DYNAMO_SCAN_SEGMENTS,
+            batch_concurrency=DYNAMO_BATCH_CONCURRENCY,
+            warmup_connections=DYNAMO_WARMUP_CONNECTIONS,
+            read_rate=DYNAMO_READ_RATE,
+            write_rate=DYNAMO_WRITE_RATE,
+            chat_state_cache_size=CHAT_STATE_CACHE_SIZE,
+            chat_state_cache_ttl=CHAT_STATE_CACHE_TTL,
+            user_cache_size=USER_CACHE_SIZE,
+            user_cache_ttl=USER_CACHE_TTL,
+            client_config=None,
+    ):
+        self.scan_segments = scan_segments
+        self.batch_concurrency = batch_concurrency
+        self.warmup_connections = warmup_connections
+        self.client_config = client_config
+
+        self.read_rate = read_rate
+        self.write_rate = write_rate
+        self.throttles = {}
+
+        self.chat_state_cache = TTLCache(
+            chat_state_cache_size,
+            chat_state_cache_ttl
+        )
+        self.user_cache = TTLCache(
+            user_cache_size,
+            user_cache_ttl
+        )
+
         self.exit_stack = None
         self.client = None
 
     async def connect(self):
-        self.exit_stack, self.client = await dynamo_client()
+        self.exit_stack, self.client = await dynamo_client(self.client_config)
+        if self.warmup_connections:
+            await dynamo_warmup(
+                self.client,
+                [CHATS_TABLE, USERS_TABLE, CONTACTS_TABLE],
+                connections=self.warmup_connections
+            )
 
     async def close(self):
         await self.exit_stack.aclose()
 
+    def cache_stats(self):
+        return {
+            'chat_state': self.chat_state_cache.stats(),
+            'user': self.user_cache.stats(),
+        }
+
+
+DB.session = session
 
+DB.iter_chats = iter_chats
+DB.put_chats = put_chats
 DB.put_chat = put_chat
+DB.delete_chat = delete_chat
 DB.get_chat = get_chat
-DB.set_chat_state = set_chat_state
-DB.reset_chat_state = reset_chat_state
-DB.get_chat_state = get_chat_state
 
 DB.get_user = get_user
+DB.get_users = get_users
+DB.iter_users = iter_users
 DB.read_users = read_users
 DB.put_user = put_user
+DB.update_user = update_user
+DB.update_users = update_users
 DB.delete_user = delete_user
 DB.put_users = put_users
 DB.delete_users = delete_users
 
 DB.get_contact = get_contact
+DB.get_contacts = get_contacts
+DB.iter_contacts = iter_contacts
 DB.read_contacts = read_contacts
+DB.iter_week_contacts = iter_week_contacts
+DB.read_week_contacts = read_week_contacts
 DB.put_contact = put_contact
+DB.update_contact = update_contact
 DB.delete_contact = delete_contact
 DB.put_contacts = put_contacts
 DB.delete_contacts = delete_contacts
+DB.commit_contacts = commit_contacts
 
+DB.read_archive_contacts = read_archive_contacts
+DB.put_archive_week = put_archive_week
+
+DB.iter_manual_matches = iter_manual_matches
 DB.read_manual_matches = read_manual_matches
 DB.put_manual_match = put_manual_match
 DB.delete_manual_match = delete_manual_match
 DB.put_manual_matches = put_manual_matches
 DB.delete_manual_matches = delete_manual_matches
+
+DB.get_pair_histories = get_pair_histories
+DB.iter_pair_histories = iter_pair_histories
+DB.read_pair_histories = read_pair_histories
+DB.update_pair_sides = update_pair_sides
+DB.merge_pair_histories = merge_pair_histories
+
+DB.get_progress = get_progress
+DB.put_progress = put_progress
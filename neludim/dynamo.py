@@ -1,21 +1,76 @@
 
-from dataclasses import is_dataclass
+import asyncio
+import random
+from time import monotonic
+from dataclasses import (
+    dataclass,
+    is_dataclass
+)
 from datetime import datetime as Datetime
 from contextlib import AsyncExitStack
 
 import aiobotocore.session
+from aiobotocore.config import AioConfig
+from botocore.exceptions import (
+    ClientError,
+    BotoCoreError
+)
 
 from .const import (
     DYNAMO_ENDPOINT,
     AWS_KEY_ID,
     AWS_KEY,
 
+    DYNAMO_MAX_POOL_CONNECTIONS,
+    DYNAMO_KEEPALIVE_TIMEOUT,
+    DYNAMO_CONNECT_TIMEOUT,
+    DYNAMO_READ_TIMEOUT,
+    DYNAMO_RETRY_MODE,
+    DYNAMO_RETRY_ATTEMPTS,
+
+    DYNAMO_BATCH_ATTEMPTS,
+    DYNAMO_BACKOFF_BASE,
+    DYNAMO_BACKOFF_CAP,
+
     N, S, M, SS
 )
 from .obj import obj_annots
+from .stats import record_stats
+from .log import (
+    log,
+    json_msg
+)
+
+
+# https://botocore.amazonaws.com/v1/documentation/api/latest/reference/config.html
+# Default pool = 10 connections, bot runs with --concurrency 16,
+# requests queue on pool. Default aiobotocore keep-alive = 12s, idle
+# container drops connections between updates
+
+
+def dynamo_config(
+        max_pool_connections=DYNAMO_MAX_POOL_CONNECTIONS,
+        keepalive_timeout=DYNAMO_KEEPALIVE_TIMEOUT,
+        connect_timeout=DYNAMO_CONNECT_TIMEOUT,
+        read_timeout=DYNAMO_READ_TIMEOUT,
+        retry_mode=DYNAMO_RETRY_MODE,
+        retry_attempts=DYNAMO_RETRY_ATTEMPTS,
+):
+    return AioConfig(
+        max_pool_connections=max_pool_connections,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        retries={
+            'mode': retry_mode,
+            'max_attempts': retry_attempts,
+        },
+        connector_args={
+            'keepalive_timeout': keepalive_timeout
+        }
+    )
 
 
-async def dynamo_client():
+async def dynamo_client(config=None):
     session = aiobotocore.session.get_session()
     manager = session.create_client(
         'dynamodb',
@@ -27,6 +82,8 @@ async def dynamo_client():
         endpoint_url=DYNAMO_ENDPOINT,
         aws_access_key_id=AWS_KEY_ID,
         aws_secret_access_key=AWS_KEY,
+
+        config=config or dynamo_config()
     )
 
     # https://github.com/aio-libs/aiobotocore/discussions/955
@@ -35,6 +92,22 @@ async def dynamo_client():
     return exit_stack, client
 
 
+# First request after cold start pays for DNS, TCP, TLS. DescribeTable
+# is cheap, consumes no capacity. Parallel calls open several pooled
+# connections, next user updates reuse them. Warmup is best effort,
+# errors are logged not raised
+
+
+async def dynamo_warmup(client, tables, connections=1):
+    try:
+        await asyncio.gather(*(
+            client.describe_table(TableName=tables[_ % len(tables)])
+            for _ in range(connections)
+        ))
+    except (ClientError, BotoCoreError) as error:
+        log.info(json_msg(warmup_error=str(error)))
+
+
 ######
 #
 #  OPS
@@ -45,44 +118,361 @@ async def dynamo_client():
 # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html
 
 
-async def dynamo_get(client, table, key_name, key_type, key_value):
-    response = await client.get_item(
-        TableName=table,
-        Key={
-            key_name: {
-                key_type: str(key_value)
-            }
-        }
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.ProjectionExpressions.html
+# name, city, state, key are reserved words, always use placeholders
+
+
+def dynamo_projection(fields):
+    names = {
+        f'#f{index}': _
+        for index, _ in enumerate(fields)
+    }
+    return {
+        'ProjectionExpression': ', '.join(names),
+        'ExpressionAttributeNames': names
+    }
+
+
+# Key is item with key attributes only: {'user_id': {'N': '1'}} or
+# {'week_index': {'N': '10'}, 'key': {'S': '1#2'}} for tables with
+# partition + sort key
+
+
+def dynamo_key_id(key):
+    return tuple(
+        (name, type, value)
+        for name, value_type in sorted(key.items())
+        for type, value in value_type.items()
+    )
+
+
+# https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+# Full jitter
+
+
+def backoff_delay(attempt, base=DYNAMO_BACKOFF_BASE, cap=DYNAMO_BACKOFF_CAP):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+# Botocore retries throttling itself, error reaches us only after
+# botocore gives up, DYNAMO_RETRY_ATTEMPTS. All items of batch
+# throttled -> error instead of UnprocessedItems.
+#
+# One retry layer per failure: manual loops below retry only what
+# botocore does not, UnprocessedItems/Keys and canceled transactions.
+# Throttling error is raised as is, not retried again on top of
+# botocore attempts
+
+THROTTLING_ERRORS = {
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+}
+
+
+def is_throttling_error(error):
+    return error.response['Error']['Code'] in THROTTLING_ERRORS
+
+
+# https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_ConsumedCapacity.html
+# Dict for single table ops, list of dicts for batch ops
+
+
+def consumed_units(response):
+    consumed = response.get('ConsumedCapacity')
+    if consumed is None:
+        return
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    return sum(_.get('CapacityUnits', 0) for _ in consumed)
+
+
+def request_table(params):
+    if 'TableName' in params:
+        return params['TableName']
+    elif 'RequestItems' in params:
+        return ','.join(params['RequestItems'])
+    else:
+        return ','.join(sorted({
+            action['TableName']
+            for item in params['TransactItems']
+            for action in item.values()
+        }))
+
+
+def response_items(op, params, response):
+    if 'Items' in response:
+        return len(response['Items'])
+    elif 'Responses' in response:
+        return sum(len(_) for _ in response['Responses'].values())
+    elif op == 'batch_write_item':
+        total = sum(len(_) for _ in params['RequestItems'].values())
+        unprocessed = sum(len(_) for _ in response.get('UnprocessedItems', {}).values())
+        return total - unprocessed
+    elif op == 'transact_write_items':
+        return len(params['TransactItems'])
+    elif op == 'get_item':
+        return int('Item' in response)
+    return 1
+
+
+# Every request goes through here. Throttle is neludim.throttle.Throttle
+# for table and capacity kind, None = no client side limit. Pay
+# estimate before call, correct with ConsumedCapacity after. Stats
+# per table and op, see neludim.stats. Attempt > 0 = our retry,
+# botocore retries are in RetryAttempts
+
+
+async def dynamo_request(method, params, throttle=None, estimate=1, attempt=0):
+    op = method.__name__
+    table = request_table(params)
+    retries = int(attempt > 0)
+
+    if throttle:
+        await throttle.acquire(estimate)
+
+    start = monotonic()
+    try:
+        response = await method(
+            ReturnConsumedCapacity='TOTAL',
+            **params
+        )
+    except (ClientError, BotoCoreError) as error:
+        record_stats(
+            table, op,
+            calls=1,
+            errors=1,
+            seconds=monotonic() - start,
+            retries=retries
+        )
+        if throttle and isinstance(error, ClientError) and is_throttling_error(error):
+            throttle.backoff()
+        raise
+
+    units = consumed_units(response)
+    record_stats(
+        table, op,
+        calls=1,
+        seconds=monotonic() - start,
+        items=response_items(op, params, response),
+        pages=int('Items' in response),
+        retries=retries + response['ResponseMetadata'].get('RetryAttempts', 0),
+        units=units or 0
+    )
+
+    if throttle:
+        throttle.settle(estimate, units)
+    return response
+
+
+async def dynamo_get(client, table, key, fields=None, throttle=None):
+    params = {}
+    if fields:
+        params.update(dynamo_projection(fields))
+
+    response = await dynamo_request(
+        client.get_item,
+        {
+            'TableName': table,
+            'Key': key,
+            **params
+        },
+        throttle
     )
     return response.get('Item')
 
 
-async def dynamo_put(client, table, item):
-    await client.put_item(
-        TableName=table,
-        Item=item
+async def dynamo_put(client, table, item, throttle=None):
+    await dynamo_request(
+        client.put_item,
+        {
+            'TableName': table,
+            'Item': item
+        },
+        throttle
     )
 
 
-async def dynamo_delete(client, table, key_name, key_type, key_value):
-    await client.delete_item(
-        TableName=table,
-        Key={
-            key_name: {
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.UpdateExpressions.html
+# Attrs {name: {type: value}} are SET, {name: None} are REMOVEd, other
+# attributes are not touched. Condition on key: do not create new item
+# from partial update, return None as dynamo_get for missing item.
+# create=True drops condition, missing item is created from attrs
+
+
+def dynamo_update_expression(key, attrs, create=False):
+    names, values = {}, {}
+    sets, removes = [], []
+    for index, (name, value) in enumerate(attrs.items()):
+        names[f'#f{index}'] = name
+        if value is None:
+            removes.append(f'#f{index}')
+        else:
+            values[f':v{index}'] = value
+            sets.append(f'#f{index} = :v{index}')
+
+    parts = []
+    if sets:
+        parts.append('SET ' + ', '.join(sets))
+    if removes:
+        parts.append('REMOVE ' + ', '.join(removes))
+
+    params = {
+        'UpdateExpression': ' '.join(parts),
+        'ExpressionAttributeNames': names,
+    }
+    if not create:
+        names['#k'] = next(iter(key))
+        params['ConditionExpression'] = 'attribute_exists(#k)'
+    if values:
+        params['ExpressionAttributeValues'] = values
+    return params
+
+
+async def dynamo_update(client, table, key, attrs, create=False, throttle=None):
+    try:
+        response = await dynamo_request(
+            client.update_item,
+            {
+                'TableName': table,
+                'Key': key,
+                'ReturnValues': 'ALL_NEW',
+                **dynamo_update_expression(key, attrs, create)
+            },
+            throttle
+        )
+    except client.exceptions.ConditionalCheckFailedException:
+        return
+    return response['Attributes']
+
+
+async def dynamo_delete(client, table, key, throttle=None):
+    await dynamo_request(
+        client.delete_item,
+        {
+            'TableName': table,
+            'Key': key
+        },
+        throttle
+    )
+
+
+# Page by page with ExclusiveStartKey instead of botocore paginator:
+# throttled page is retried by botocore with the same key, scan does
+# not restart. Next page is estimated by cost of previous one
+
+
+async def dynamo_pages(method, params, throttle=None):
+    estimate = 1
+    while True:
+        response = await dynamo_request(method, params, throttle, estimate)
+        yield response['Items']
+
+        estimate = consumed_units(response) or estimate
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            break
+        params = {**params, 'ExclusiveStartKey': last_key}
+
+
+async def dynamo_scan_segment_pages(client, table, segment=None, total_segments=None, fields=None, throttle=None):
+    params = {'TableName': table}
+    if total_segments:
+        params.update(
+            Segment=segment,
+            TotalSegments=total_segments
+        )
+    if fields:
+        params.update(dynamo_projection(fields))
+
+    async for items in dynamo_pages(client.scan, params, throttle):
+        yield items
+
+
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Query.html
+# All items with partition key = key_value, cost ~ size of partition
+# not size of table
+
+
+async def dynamo_query_pages(client, table, key_name, key_type, key_value, fields=None, throttle=None):
+    params = {
+        'TableName': table,
+        'KeyConditionExpression': '#k = :k',
+        'ExpressionAttributeNames': {'#k': key_name},
+        'ExpressionAttributeValues': {
+            ':k': {
                 key_type: str(key_value)
             }
         }
-    )
+    }
+    if fields:
+        projection = dynamo_projection(fields)
+        params['ProjectionExpression'] = projection['ProjectionExpression']
+        params['ExpressionAttributeNames'].update(projection['ExpressionAttributeNames'])
 
+    async for items in dynamo_pages(client.query, params, throttle):
+        yield items
 
-async def dynamo_scan(client, table):
-    pager = client.get_paginator('scan')
-    responses = pager.paginate(
-        TableName=table
-    )
+
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Scan.html#Scan.ParallelScan
+# Each segment is paged independently over the same client, total
+# time ~ time to page the largest segment. Segments push pages to
+# bounded queue, at most ~segments pages wait in memory
+
+
+async def dynamo_scan_pages(client, table, segments=1, fields=None, throttle=None):
+    if segments <= 1:
+        pages = dynamo_scan_segment_pages(
+            client, table,
+            fields=fields,
+            throttle=throttle
+        )
+        async for items in pages:
+            yield items
+        return
+
+    queue = asyncio.Queue(maxsize=segments)
+
+    async def scan_segment(segment):
+        try:
+            pages = dynamo_scan_segment_pages(
+                client, table,
+                segment=segment,
+                total_segments=segments,
+                fields=fields,
+                throttle=throttle
+            )
+            async for items in pages:
+                await queue.put(items)
+        except Exception as error:
+            await queue.put(error)
+        else:
+            await queue.put(None)
+
+    tasks = [
+        asyncio.create_task(scan_segment(_))
+        for _ in range(segments)
+    ]
+    try:
+        pending = segments
+        while pending:
+            items = await queue.get()
+            if items is None:
+                pending -= 1
+            elif isinstance(items, Exception):
+                raise items
+            else:
+                yield items
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def dynamo_scan(client, table, segments=1, fields=None, throttle=None):
     items = []
-    async for response in responses:
-        items.extend(response['Items'])
+    async for page in dynamo_scan_pages(client, table, segments, fields, throttle):
+        items.extend(page)
     return items
 
 
@@ -97,40 +487,212 @@ def iter_batches(items, max_size=25):
         yield batch
 
 
-async def dynamo_batch_put(client, table, items):
-    for batch in iter_batches(items):
-        await client.batch_write_item(
-            RequestItems={
-                table: [
-                    {
-                        'PutRequest': {
-                            'Item': _
-                        }
-                    }
-                    for _ in batch
-                ]
+# Unprocessed items = table is over capacity, same signal for throttle
+# as throttling error
+
+
+async def dynamo_batch_write(client, table, requests, concurrency=1, throttle=None, attempts=DYNAMO_BATCH_ATTEMPTS):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def write_batch(batch):
+        async with semaphore:
+            for attempt in range(attempts):
+                if attempt:
+                    await asyncio.sleep(backoff_delay(attempt))
+
+                response = await dynamo_request(
+                    client.batch_write_item,
+                    {'RequestItems': {table: batch}},
+                    throttle,
+                    estimate=len(batch),
+                    attempt=attempt
+                )
+                batch = response.get('UnprocessedItems', {}).get(table)
+                if not batch:
+                    return 0
+                if throttle:
+                    throttle.backoff()
+
+            return len(batch)
+
+    failed = sum(await asyncio.gather(*(
+        write_batch(_)
+        for _ in iter_batches(requests)
+    )))
+    if failed:
+        log.info(json_msg(table=table, failed=failed))
+    return failed
+
+
+async def dynamo_batch_put(client, table, items, concurrency=1, throttle=None):
+    requests = (
+        {
+            'PutRequest': {
+                'Item': _
             }
-        )
+        }
+        for _ in items
+    )
+    return await dynamo_batch_write(
+        client, table, requests,
+        concurrency=concurrency,
+        throttle=throttle
+    )
 
 
-async def dynamo_batch_delete(client, table, key_name, key_type, key_values):
-    for batch in iter_batches(key_values):
-        await client.batch_write_item(
-            RequestItems={
-                table: [
+async def dynamo_batch_delete(client, table, keys, concurrency=1, throttle=None):
+    requests = (
+        {
+            'DeleteRequest': {
+                'Key': _
+            }
+        }
+        for _ in keys
+    )
+    return await dynamo_batch_write(
+        client, table, requests,
+        concurrency=concurrency,
+        throttle=throttle
+    )
+
+
+# Strongly consistent read of item up to 4KB = 1 unit, BatchGetItem is
+# eventually consistent by default = half. Keys left unprocessed after
+# all attempts raise: for caller throttled key and missing item would
+# look the same
+
+
+class DynamoUnprocessedKeys(Exception):
+    pass
+
+
+async def dynamo_batch_get(client, table, keys, fields=None, concurrency=1, throttle=None, attempts=DYNAMO_BATCH_ATTEMPTS):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    params = {}
+    if fields:
+        params.update(dynamo_projection(fields))
+
+    async def get_batch(keys):
+        items = []
+        async with semaphore:
+            for attempt in range(attempts):
+                if attempt:
+                    await asyncio.sleep(backoff_delay(attempt))
+
+                response = await dynamo_request(
+                    client.batch_get_item,
                     {
-                        'DeleteRequest': {
-                            'Key': {
-                                key_name: {
-                                    key_type: str(_)
-                                }
+                        'RequestItems': {
+                            table: {
+                                'Keys': keys,
+                                **params
                             }
                         }
-                    }
-                    for _ in batch
-                ]
-            }
+                    },
+                    throttle,
+                    estimate=len(keys) / 2,
+                    attempt=attempt
+                )
+                items.extend(response['Responses'].get(table, []))
+                keys = (
+                    response.get('UnprocessedKeys', {})
+                    .get(table, {})
+                    .get('Keys')
+                )
+                if not keys:
+                    return items, 0
+                if throttle:
+                    throttle.backoff()
+
+        return items, len(keys)
+
+    # BatchGetItem fails on duplicate keys
+    keys = {
+        dynamo_key_id(_): _
+        for _ in keys
+    }.values()
+    results = await asyncio.gather(*(
+        get_batch(_)
+        for _ in iter_batches(keys, max_size=100)
+    ))
+
+    items, failed = [], 0
+    for batch_items, batch_failed in results:
+        items.extend(batch_items)
+        failed += batch_failed
+
+    if failed:
+        log.info(json_msg(table=table, failed=failed))
+        raise DynamoUnprocessedKeys(f'{table}: {failed} keys unprocessed')
+    return items
+
+
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/transaction-apis.html
+# All or nothing. Transaction costs 2x units. Canceled transaction has
+# reason per item in request order: conflicts, throttling and cancel
+# without reasons (unknown cause, not committed) are retried, condition
+# failures are returned to caller as list of codes, None = committed
+
+
+def dynamo_transact_put(table, item, condition=None, names=None):
+    put = {
+        'TableName': table,
+        'Item': item
+    }
+    if condition:
+        put.update(
+            ConditionExpression=condition,
+            ExpressionAttributeNames=names
         )
+    return {'Put': put}
+
+
+def dynamo_transact_update(table, key, attrs):
+    return {
+        'Update': {
+            'TableName': table,
+            'Key': key,
+            **dynamo_update_expression(key, attrs)
+        }
+    }
+
+
+TRANSACTION_RETRY_CODES = {
+    'TransactionConflict',
+    'ThrottlingError',
+    'ProvisionedThroughputExceeded',
+}
+
+
+async def dynamo_transact_write(client, items, throttle=None, attempts=DYNAMO_BATCH_ATTEMPTS):
+    for attempt in range(attempts):
+        if attempt:
+            await asyncio.sleep(backoff_delay(attempt))
+
+        try:
+            await dynamo_request(
+                client.transact_write_items,
+                {'TransactItems': items},
+                throttle,
+                estimate=2 * len(items),
+                attempt=attempt
+            )
+            return
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+
+            codes = [
+                _.get('Code')
+                for _ in error.response.get('CancellationReasons', [])
+            ]
+            retry = not codes or TRANSACTION_RETRY_CODES & set(codes)
+            if retry and attempt + 1 < attempts:
+                if throttle:
+                    throttle.backoff()
+                continue
+            return codes
 
 
 ######
@@ -197,6 +759,106 @@ def dynamo_serialize_item(obj):
     return item
 
 
+######
+#
+#   CODEC
+#
+#####
+
+
+# dynamo_de/serialize_item resolve annotations for every field of
+# every item. Codec does it once per dataclass: field name, dynamo
+# type, value converter. Converter is None when value is stored as is
+
+
+@dataclass
+class DynamoCodec:
+    serialize: callable
+    deserialize: callable
+    serialize_fields: callable
+
+
+def dynamo_value_converters(annot):
+    if annot == int:
+        return str, int
+    elif annot in (str, [str]):
+        return None, None
+    elif annot == Datetime:
+        return Datetime.isoformat, Datetime.fromisoformat
+    elif is_dataclass(annot):
+        codec = dynamo_codec(annot)
+        return codec.serialize, codec.deserialize
+
+
+def build_dynamo_codec(cls):
+    specs = []
+    for name, annot in obj_annots(cls):
+        type = dynamo_type(annot)
+        serialize_value, deserialize_value = dynamo_value_converters(annot)
+        specs.append((name, type, serialize_value, deserialize_value))
+
+    def serialize(obj):
+        item = {}
+        for name, type, serialize_value, _ in specs:
+            value = getattr(obj, name)
+            if value is not None:
+                if serialize_value:
+                    value = serialize_value(value)
+                item[name] = {type: value}
+        return item
+
+    def deserialize(item):
+        kwargs = {}
+        for name, type, _, deserialize_value in specs:
+            value = item.get(name)
+            if value is not None:
+                value = value[type]
+                if deserialize_value:
+                    value = deserialize_value(value)
+            kwargs[name] = value
+        return cls(**kwargs)
+
+    # Partial update, {name: value} -> {name: {type: value}}, None
+    # values stay None = remove attribute
+    name_specs = {_[0]: _ for _ in specs}
+
+    def serialize_fields(values):
+        attrs = {}
+        for name, value in values.items():
+            _, type, serialize_value, _ = name_specs[name]
+            if value is not None:
+                if serialize_value:
+                    value = serialize_value(value)
+                value = {type: value}
+            attrs[name] = value
+        return attrs
+
+    return DynamoCodec(serialize, deserialize, serialize_fields)
+
+
+DYNAMO_CODECS = {}
+
+
+def dynamo_codec(cls):
+    codec = DYNAMO_CODECS.get(cls)
+    if not codec:
+        codec = build_dynamo_codec(cls)
+        DYNAMO_CODECS[cls] = codec
+    return codec
+
+
+def dynamo_encode_item(obj):
+    return dynamo_codec(type(obj)).serialize(obj)
+
+
+def dynamo_decode_item(item, cls):
+    return dynamo_codec(cls).deserialize(item)
+
+
+def dynamo_encode_fields(cls, values):
+    return dynamo_codec(cls).serialize_fields(values)
+
+
 # On DynamoDB partition key
 # https://aws.amazon.com/ru/blogs/database/choosing-the-right-dynamodb-partition-key/
 
@@ -0,0 +1,111 @@
+
+# Matching needs per pair: last week of contact, strongest state
+# (confirm > fail > none), worst feedback score (bad > ok > great >
+# none) over both directions and all weeks. Rebuilding it from whole
+# contacts history on every run grows with history, pair history
+# table keeps the aggregate, contacts writes merge into it.
+#
+# Stored per pair: one attribute per contact side,
+# side#{week_index}#{user_id} = state, feedback_score. Merge sets only
+# attributes of given contacts, UpdateItem, item is created if
+# missing. Partners answer feedback at the same time: different
+# attributes, both are kept. Changed answer overwrites own side,
+# aggregate is computed on read from all sides, exact
+
+from collections import defaultdict
+
+from .obj import (
+    Contact,
+    PairHistory,
+)
+from .const import (
+    CONFIRM_STATE,
+    FAIL_STATE,
+
+    BAD_SCORE,
+    OK_SCORE,
+    GREAT_SCORE,
+)
+
+
+STATE_PRIORITY = [CONFIRM_STATE, FAIL_STATE, None]
+SCORE_PRIORITY = [BAD_SCORE, OK_SCORE, GREAT_SCORE, None]
+
+
+def pair_key(user_id, partner_user_id):
+    if user_id > partner_user_id:
+        return partner_user_id, user_id
+    return user_id, partner_user_id
+
+
+def top_priority(priority, a, b):
+    if priority.index(a) <= priority.index(b):
+        return a
+    return b
+
+
+def merge_pair_history(history, contact):
+    if not history:
+        user_id, partner_user_id = pair_key(contact.user_id, contact.partner_user_id)
+        return PairHistory(
+            user_id, partner_user_id,
+            week_index=contact.week_index,
+            state=contact.state,
+            feedback_score=contact.feedback_score
+        )
+
+    return PairHistory(
+        history.user_id, history.partner_user_id,
+        week_index=max(history.week_index, contact.week_index),
+        state=top_priority(STATE_PRIORITY, history.state, contact.state),
+        feedback_score=top_priority(SCORE_PRIORITY, history.feedback_score, contact.feedback_score)
+    )
+
+
+def gen_pair_histories(contacts):
+    key_histories = {}
+    for contact in contacts:
+        if contact.partner_user_id:
+            key = pair_key(contact.user_id, contact.partner_user_id)
+            key_histories[key] = merge_pair_history(key_histories.get(key), contact)
+    return list(key_histories.values())
+
+
+PAIR_SIDE_PREFIX = 'side#'
+
+
+def pair_side_name(contact):
+    return f'{PAIR_SIDE_PREFIX}{contact.week_index}#{contact.user_id}'
+
+
+def gen_pair_sides(contacts):
+    key_sides = defaultdict(dict)
+    for contact in contacts:
+        if contact.partner_user_id:
+            key = pair_key(contact.user_id, contact.partner_user_id)
+            name = pair_side_name(contact)
+            key_sides[key][name] = (contact.state, contact.feedback_score)
+    return dict(key_sides)
+
+
+def parse_pair_history(key, sides):
+    history = None
+    for name, (state, feedback_score) in sorted(sides.items()):
+        _, week_index, user_id = name.split('#')
+        user_id = int(user_id)
+        partner_user_id = key[1] if user_id == key[0] else key[0]
+        contact = Contact(
+            int(week_index), user_id, partner_user_id,
+            state=state,
+            feedback_score=feedback_score
+        )
+        history = merge_pair_history(history, contact)
+    return history
+
+
+# Same for all backends, db.update_pair_sides writes sides of each
+# pair atomically. Returns number of failed pairs
+
+
+async def merge_pair_histories(db, contacts):
+    return await db.update_pair_sides(gen_pair_sides(contacts))
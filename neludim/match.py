@@ -14,21 +14,35 @@
 # pairs.
 
 # To alleviate this problem algo repeat procedure 10 times, returns
-# matches with miniman number of no pairs.
+# matches with miniman number of no pairs. More rounds = better
+# matches, see MATCH_ROUNDS, MATCH_WORKERS to run rounds in parallel.
+
+# Exact engine solves the problem: maximum weight matching (blossom,
+# networkx) with max cardinality, score tuple encoded as integer
+# weight, see lex_weight. Optimal number of pairs, then of new pairs,
+# etc in one pass. Slow, ~O(N^3), select_match_engine falls back to
+# greedy for large weeks. Compare with python -m neludim.bench match
 
 
 import random
 from dataclasses import dataclass
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 from .obj import Match
+from .history import gen_pair_histories
 from .const import (
     CONFIRM_STATE,
-    FAIL_STATE,
-
-    BAD_SCORE,
-    OK_SCORE,
-    GREAT_SCORE
+    GREAT_SCORE,
+
+    GREEDY_MATCH_ENGINE,
+    EXACT_MATCH_ENGINE,
+    AUTO_MATCH_ENGINE,
+    MATCH_ENGINE,
+    MATCH_EXACT_MAX_USERS,
+    MATCH_ROUNDS,
+    MATCH_WORKERS,
 )
 
 
@@ -39,141 +53,328 @@ class SampleMatch:
     is_new: bool
 
 
-def gen_matches_sample(users, stats, current_week_index, seed=0):
+def sort2(a, b):
+    if a > b:
+        return b, a
+    return a, b
+
+
+# Pair aggregates come from pair history table, see neludim.history
+
+
+def match_stats(manual_matches, pair_histories):
+    key_week_indexes = {}
+    key_states = {}
+    key_feedback_scores = {}
+    for history in pair_histories:
+        key = history.key
+        key_week_indexes[key] = history.week_index
+        key_states[key] = history.state
+        key_feedback_scores[key] = history.feedback_score
+
+    manual_match_keys = set()
+    for match in manual_matches:
+        key = sort2(match.user_id, match.partner_user_id)
+        manual_match_keys.add(key)
+
+    return key_week_indexes, key_states, key_feedback_scores, manual_match_keys
+
+
+#######
+#
+#   PAIRS
+#
+#####
+
+
+# Pair scores as array ops. User features are packed into arrays
+# once per gen_matches call, history and manual matches go to pair
+# matrices by user index. Allowed pairs are listed row-major, same
+# order as nested loop over users. Score tuple (is_new,
+# is_manual_match, same_city, match_about) is packed to 4 bit class,
+# same lexicographic order
+
+
+@dataclass
+class MatchPairs:
+    user_ids: np.ndarray
+    rows: np.ndarray
+    cols: np.ndarray
+    classes: np.ndarray
+
+
+IS_NEW_BIT = 3
+SCORE_BITS = 4
+
+
+def user_features(users):
+    user_ids = np.array([_.user_id for _ in users], dtype=np.int64)
+
+    city_codes = {}
+    cities = np.array(
+        [
+            city_codes.setdefault(_.city, len(city_codes)) if _.city else -1
+            for _ in users
+        ],
+        dtype=np.int64
+    )
+
+    has_about = np.array(
+        [_.links is not None or _.about is not None for _ in users],
+        dtype=bool
+    )
+    return user_ids, cities, has_about
+
+
+def pair_indexes(keys, id_indexes):
+    keys = [
+        key for key in keys
+        if key[0] in id_indexes and key[1] in id_indexes
+    ]
+    rows = np.array([id_indexes[_] for _, __ in keys], dtype=np.int64)
+    cols = np.array([id_indexes[_] for __, _ in keys], dtype=np.int64)
+    return keys, rows, cols
+
+
+def match_pairs(users, stats, current_week_index):
     key_week_indexes, key_states, key_feedback_scores, manual_match_keys = stats
-    random.seed(seed)
-
-    def score_match(user, partner_user):
-        key = user.user_id, partner_user.user_id
-
-        do_repeat = False
-        week_index = key_week_indexes.get(key)
-        if week_index is not None:
-            feedback_score = key_feedback_scores[key]
-            if (
-                    feedback_score == GREAT_SCORE
-                    and current_week_index - week_index > 8
-            ):
-                do_repeat = True
-
-            state = key_states[key]
-            if (
-                    state != CONFIRM_STATE
-                    and current_week_index - week_index > 4
-            ):
-                do_repeat = True
-
-            if not do_repeat:
-                return
-
-        is_manual_match = key in manual_match_keys
-
-        has_about = user.links is not None or user.about is not None
-        partner_has_about = partner_user.links is not None or partner_user.about is not None
-        match_about = (
-            has_about and partner_has_about
-            or not has_about and not partner_has_about
+    user_ids, cities, has_about = user_features(users)
+    id_indexes = {id: index for index, id in enumerate(user_ids.tolist())}
+
+    size = len(users)
+    allowed = user_ids[:, None] < user_ids[None, :]
+    is_new = np.ones((size, size), dtype=bool)
+    is_manual_match = np.zeros((size, size), dtype=bool)
+
+    # Met pair is allowed again after great feedback or failed meeting
+    keys, rows, cols = pair_indexes(key_week_indexes, id_indexes)
+    if keys:
+        weeks_ago = current_week_index - np.array([key_week_indexes[_] for _ in keys])
+        is_great = np.array([key_feedback_scores[_] == GREAT_SCORE for _ in keys])
+        is_confirm = np.array([key_states[_] == CONFIRM_STATE for _ in keys])
+        do_repeat = (
+            is_great & (weeks_ago > 8)
+            | ~is_confirm & (weeks_ago > 4)
         )
+        allowed[rows, cols] &= do_repeat
+        is_new[rows, cols] = False
+
+    keys, rows, cols = pair_indexes(manual_match_keys, id_indexes)
+    if keys:
+        is_manual_match[rows, cols] = True
+
+    rows, cols = np.nonzero(allowed)
+    same_city = (cities[rows] == cities[cols]) & (cities[rows] >= 0)
+    match_about = has_about[rows] == has_about[cols]
+    classes = (
+        is_new[rows, cols].astype(np.uint8) << IS_NEW_BIT
+        | is_manual_match[rows, cols].astype(np.uint8) << 2
+        | same_city.astype(np.uint8) << 1
+        | match_about.astype(np.uint8)
+    )
+    return MatchPairs(user_ids, rows, cols, classes)
+
+
+#######
+#
+#   GREEDY
+#
+#####
+
+
+# Same order as size random() calls, generator is left in same state.
+# random() takes 2 32 bit words a, b: ((a >> 5) * 2^26 + (b >> 6)) /
+# 2^53, getrandbits(64 * size) returns same words, first is lowest.
+# Return 53 bit numerators, sort key is class << 53 | numerator, one
+# argsort instead of lexsort. Equal keys are practically impossible,
+# no need for stable sort
+
 
-        same_city = False
-        if user.city and partner_user.city:
-            same_city = user.city == partner_user.city
+def random_numerators(rng, size):
+    if not size:
+        return np.zeros(0, dtype=np.uint64)
 
-        is_new = not do_repeat
-        return (
-            is_new,
-            is_manual_match,
-            same_city,
-            match_about,
+    data = rng.getrandbits(64 * size).to_bytes(8 * size, 'little')
+    words = np.frombuffer(data, dtype='<u4').astype(np.uint64)
+    return (words[0::2] >> 5) << 26 | (words[1::2] >> 6)
 
-            # shuffle same
-            random.random()
+
+# Greedy usually stops halfway, convert sorted pairs to lists lazily
+
+
+def iter_sorted_pairs(pairs, order, chunk_size=2 ** 16):
+    for start in range(0, len(order), chunk_size):
+        chunk = order[start:start + chunk_size]
+        yield from zip(
+            pairs.rows[chunk].tolist(),
+            pairs.cols[chunk].tolist(),
+            pairs.classes[chunk].tolist()
         )
 
-    score_keys = []
-    for user in users:
-        for partner_user in users:
-            if user.user_id >= partner_user.user_id:
-                continue
 
-            score = score_match(user, partner_user)
-            if score:
-                key = user.user_id, partner_user.user_id
-                score_keys.append((score, key))
+def gen_matches_sample(pairs, rng):
+    # shuffle same, only random part is redrawn per round
+    keys = pairs.classes.astype(np.uint64) << 53 | random_numerators(rng, len(pairs.classes))
+    order = np.argsort(keys)[::-1]
 
-    matched_user_ids = set()
-    for score, (user_id, partner_user_id) in sorted(score_keys, reverse=True):
-        if (
-                user_id in matched_user_ids
-                or partner_user_id in matched_user_ids
-        ):
+    user_ids = pairs.user_ids.tolist()
+    matched = [False] * len(user_ids)
+    matched_count = 0
+    for row, col, score_class in iter_sorted_pairs(pairs, order):
+        if matched[row] or matched[col]:
             continue
 
-        matched_user_ids.add(user_id)
-        matched_user_ids.add(partner_user_id)
+        matched[row] = matched[col] = True
+        is_new = bool(score_class >> IS_NEW_BIT)
+        yield SampleMatch(user_ids[row], user_ids[col], is_new)
 
-        is_new, *_ = score
-        yield SampleMatch(user_id, partner_user_id, is_new)
+        matched_count += 2
+        if matched_count >= len(user_ids) - 1:
+            break
 
 
-def sort2(a, b):
-    if a > b:
-        return b, a
-    return a, b
+# Round has own generator, rounds are independent, same result in
+# any order or process
 
 
-def gen_matches(users, manual_matches=(), contacts=(), current_week_index=0, rounds=10):
-    key_contacts = defaultdict(list)
-    for contact in sorted(contacts, key=lambda _: _.week_index):
-        if contact.partner_user_id:
-            key = sort2(contact.user_id, contact.partner_user_id)
-            key_contacts[key].append(contact)
+def gen_matches_round(pairs, seed):
+    rng = random.Random(seed)
+    sample = list(gen_matches_sample(pairs, rng))
 
-    key_week_indexes = {}
-    key_states = {}
-    key_feedback_scores = {}
-    for key, group in key_contacts.items():
-        key_week_indexes[key] = max(_.week_index for _ in group)
+    matched_count = len(sample)
+    is_new_count = sum(_.is_new for _ in sample)
+    score = (
+        matched_count,
+        is_new_count,
+        rng.random()
+    )
+    return score, sample
 
-        states = {_.state for _ in group}
-        for state in [CONFIRM_STATE, FAIL_STATE, None]:
-            if state in states:
-                key_states[key] = state
-                break
 
-        feedback_scores = {_.feedback_score for _ in group}
-        for feedback_score in [BAD_SCORE, OK_SCORE, GREAT_SCORE, None]:
-            if feedback_score in feedback_scores:
-                key_feedback_scores[key] = feedback_score
-                break
+# Parallel mode: pairs arrays are sent to every worker once with
+# initializer, task is just seed. Worth it for hundreds of rounds on
+# multi core host, each worker holds own copy of pairs
 
-    manual_match_keys = set()
-    for match in manual_matches:
-        key = sort2(match.user_id, match.partner_user_id)
-        manual_match_keys.add(key)
+WORKER_PAIRS = None
 
-    stats = (key_week_indexes, key_states, key_feedback_scores, manual_match_keys)
 
-    def score_sample(matches):
-        matched_count = len(matches)
-        is_new_count = sum(_.is_new for _ in matches)
-        return (
-            matched_count,
-            is_new_count,
-            random.random()
-        )
+def init_round_worker(pairs):
+    global WORKER_PAIRS
+    WORKER_PAIRS = pairs
+
+
+def run_round_worker(seed):
+    return gen_matches_round(WORKER_PAIRS, seed)
+
 
-    score_samples = []
-    for seed in range(rounds):
-        sample = list(gen_matches_sample(
-            users, stats,
-            current_week_index=current_week_index,
-            seed=seed
-        ))
-        score = score_sample(sample)
-        score_samples.append((score, sample))
+def gen_matches_greedy(users, stats, current_week_index, rounds=MATCH_ROUNDS, workers=MATCH_WORKERS):
+    pairs = match_pairs(users, stats, current_week_index)
+
+    if workers:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_round_worker,
+            initargs=(pairs,)
+        )
+        with executor:
+            score_samples = list(executor.map(
+                run_round_worker, range(rounds),
+                chunksize=max(1, rounds // (workers * 4))
+            ))
+    else:
+        score_samples = [
+            gen_matches_round(pairs, seed)
+            for seed in range(rounds)
+        ]
 
     _, sample = max(score_samples)
+    return sample
+
+
+#######
+#
+#   EXACT
+#
+#####
+
+
+# Lexicographic order as sum order: every level is bool, matching has
+# at most N/2 pairs, sum of lower level < 1 unit of upper level if
+# base > N/2. Last level shuffles same scores, N/2 random values <
+# shuffle each, unit of previous level is base * shuffle
+
+
+def lex_weight(score_class, base, shuffle, value):
+    weight = 0
+    for bit in reversed(range(SCORE_BITS)):
+        weight = weight * base + (score_class >> bit & 1)
+    return weight * base * shuffle + value
+
+
+def gen_matches_exact(users, stats, current_week_index, seed=0, shuffle=1000):
+    # Heavy import, only exact engine needs it
+    import networkx
+
+    rng = random.Random(seed)
+    base = len(users) // 2 + 1
+    pairs = match_pairs(users, stats, current_week_index)
+    user_ids = pairs.user_ids.tolist()
+
+    graph = networkx.Graph()
+    items = zip(
+        pairs.rows.tolist(),
+        pairs.cols.tolist(),
+        pairs.classes.tolist()
+    )
+    for row, col, score_class in items:
+        weight = lex_weight(score_class, base, shuffle, rng.randrange(shuffle))
+        graph.add_edge(
+            user_ids[row], user_ids[col],
+            weight=weight,
+            is_new=bool(score_class >> IS_NEW_BIT)
+        )
+
+    score_matches = []
+    for pair in networkx.max_weight_matching(graph, maxcardinality=True):
+        edge = graph.edges[pair]
+        user_id, partner_user_id = sort2(*pair)
+        match = SampleMatch(user_id, partner_user_id, edge['is_new'])
+        score_matches.append((edge['weight'], match))
+
+    # Same order as greedy, best pairs first
+    score_matches.sort(key=lambda _: _[0], reverse=True)
+    return [match for _, match in score_matches]
+
+
+#######
+#
+#   SELECT
+#
+#####
+
+
+def select_match_engine(users, engine=MATCH_ENGINE, exact_max_users=MATCH_EXACT_MAX_USERS):
+    if engine == AUTO_MATCH_ENGINE:
+        if len(users) <= exact_max_users:
+            return EXACT_MATCH_ENGINE
+        return GREEDY_MATCH_ENGINE
+    return engine
+
+
+def gen_matches(
+        users, manual_matches=(), contacts=(), current_week_index=0,
+        rounds=MATCH_ROUNDS, workers=MATCH_WORKERS, engine=MATCH_ENGINE,
+        pair_histories=None
+):
+    if pair_histories is None:
+        pair_histories = gen_pair_histories(contacts)
+    stats = match_stats(manual_matches, pair_histories)
+
+    engine = select_match_engine(users, engine)
+    if engine == EXACT_MATCH_ENGINE:
+        sample = gen_matches_exact(users, stats, current_week_index)
+    else:
+        sample = gen_matches_greedy(users, stats, current_week_index, rounds, workers)
 
     matched_user_ids = set()
     for match in sample:
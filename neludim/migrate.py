@@ -0,0 +1,126 @@
+# Contacts used to live in one table keyed by
+# week_index#user_id#partner_user_id string, weekly ops scanned the
+# whole history to use one week. Now week_index is partition key,
+# user_id#partner_user_id is sort key, ops query one week.
+# migrate_contacts creates new table, copies legacy items rewriting
+# keys. Safe to rerun only before cutover: after bot writes to new
+# table, copy overwrites newer items with legacy ones. Legacy table is
+# left as is, drop manually after checking counts in log
+#
+# Chats written before Chat.expires have no TTL attribute, Dynamo TTL
+# never removes them. migrate_chat_expires sets expires = now +
+# CHAT_STATE_TTL on such items. UpdateItem sets only expires: state
+# written by bot meanwhile is kept, chat deleted meanwhile is not
+# recreated. Safe to rerun
+
+
+import asyncio
+from time import time
+
+from .log import (
+    log,
+    json_msg
+)
+from .const import (
+    CONTACTS_TABLE,
+    CONTACTS_WEEK_KEY,
+    CONTACTS_KEY,
+    LEGACY_CONTACTS_TABLE,
+    CHATS_TABLE,
+    CHATS_KEY,
+    CHAT_STATE_TTL,
+
+    N, S,
+)
+from .obj import Contact
+from .dynamo import (
+    dynamo_scan_pages,
+    dynamo_decode_item,
+    dynamo_update,
+)
+
+
+async def create_contacts_table(client):
+    try:
+        await client.create_table(
+            TableName=CONTACTS_TABLE,
+            KeySchema=[
+                {
+                    'AttributeName': CONTACTS_WEEK_KEY,
+                    'KeyType': 'HASH'
+                },
+                {
+                    'AttributeName': CONTACTS_KEY,
+                    'KeyType': 'RANGE'
+                },
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': CONTACTS_WEEK_KEY,
+                    'AttributeType': N
+                },
+                {
+                    'AttributeName': CONTACTS_KEY,
+                    'AttributeType': S
+                },
+            ],
+            BillingMode='PAY_PER_REQUEST'
+        )
+    except client.exceptions.ResourceInUseException:
+        # Rerun, table already created
+        pass
+
+    waiter = client.get_waiter('table_exists')
+    await waiter.wait(TableName=CONTACTS_TABLE)
+
+
+async def migrate_contacts(context):
+    db = context.db
+    await create_contacts_table(db.client)
+
+    total, failed = 0, 0
+    pages = dynamo_scan_pages(
+        db.client, LEGACY_CONTACTS_TABLE,
+        segments=db.scan_segments
+    )
+    async for items in pages:
+        contacts = [dynamo_decode_item(_, Contact) for _ in items]
+        failed += await db.put_contacts(contacts)
+        total += len(contacts)
+
+    log.info(json_msg(
+        task='migrate_contacts',
+        total=total,
+        failed=failed
+    ))
+
+
+async def migrate_chat_expires(context, timer=time):
+    db = context.db
+    expires = {N: str(int(timer() + CHAT_STATE_TTL))}
+    semaphore = asyncio.Semaphore(db.batch_concurrency)
+
+    async def update(item):
+        async with semaphore:
+            return await dynamo_update(
+                db.client, CHATS_TABLE,
+                {CHATS_KEY: item[CHATS_KEY]},
+                {'expires': expires}
+            )
+
+    total, updated = 0, 0
+    pages = dynamo_scan_pages(
+        db.client, CHATS_TABLE,
+        segments=db.scan_segments
+    )
+    async for items in pages:
+        items = [_ for _ in items if 'expires' not in _]
+        results = await asyncio.gather(*(update(_) for _ in items))
+        total += len(items)
+        updated += sum(1 for _ in results if _)
+
+    log.info(json_msg(
+        task='migrate_chat_expires',
+        total=total,
+        updated=updated
+    ))
@@ -18,6 +18,12 @@ class Chat:
     id: int
     state: str = None
 
+    # aiogram FSM data, JSON, see neludim.bot.storage
+    data: str = None
+
+    # Unix time, Dynamo TTL attribute
+    expires: int = None
+
 
 @dataclass
 class User:
@@ -60,6 +66,31 @@ class Contact:
             )
 
 
+# Aggregate of all contacts of pair: last week, strongest state,
+# worst feedback score, see neludim.history
+
+
+@dataclass
+class PairHistory:
+    user_id: int
+    partner_user_id: int
+    week_index: int = None
+
+    state: str = None
+    feedback_score: str = None
+
+    @property
+    def key(self):
+        return (self.user_id, self.partner_user_id)
+
+
+@dataclass
+class Progress:
+    key: str
+    data: str = None
+    done: Datetime = None
+
+
 @dataclass
 class Match:
     user_id: int
@@ -0,0 +1,122 @@
+# Snapshot of all tables to local files, run reports, matching
+# experiments, benchmarks without read load on live tables. One
+# gzipped JSONL file per table, line = item in Dynamo format, same
+# format for DB and SqliteDB. Export streams parallel scan pages,
+# import loads chunks with concurrent batch writes. Typical flow:
+#
+# neludim export data/
+# DB_BACKEND=sqlite neludim import data/
+
+
+import gzip
+from pathlib import Path
+from functools import partial
+from json import (
+    loads as parse_json,
+    dumps as format_json
+)
+
+from .log import (
+    log,
+    json_msg
+)
+from .obj import (
+    Chat,
+    User,
+    Contact,
+    Match,
+)
+from .dynamo import (
+    dynamo_encode_item,
+    dynamo_decode_item,
+)
+
+
+# Fast enough for 10k+ items, ~same size as level 9
+SNAPSHOT_COMPRESS_LEVEL = 6
+SNAPSHOT_CHUNK_SIZE = 1000
+
+CHATS = 'chats'
+USERS = 'users'
+CONTACTS = 'contacts'
+MANUAL_MATCHES = 'manual_matches'
+
+SNAPSHOT_TABLES = [
+    USERS,
+    CONTACTS,
+    MANUAL_MATCHES,
+    CHATS,
+]
+
+
+# Archived weeks go to contacts file too, import puts them to hot
+# table, next archive_contacts moves them back
+
+
+async def iter_all_contacts(db):
+    for contact in await db.read_archive_contacts():
+        yield contact
+    async for contact in db.iter_contacts():
+        yield contact
+
+
+def snapshot_table(db, name):
+    return {
+        CHATS: (Chat, db.iter_chats, db.put_chats),
+        USERS: (User, db.iter_users, db.put_users),
+        CONTACTS: (Contact, partial(iter_all_contacts, db), db.put_contacts),
+        MANUAL_MATCHES: (Match, db.iter_manual_matches, db.put_manual_matches),
+    }[name]
+
+
+def snapshot_path(dir, name):
+    return Path(dir) / f'{name}.jsonl.gz'
+
+
+async def export_table(db, dir, name):
+    _, iter_objs, _ = snapshot_table(db, name)
+    path = snapshot_path(dir, name)
+
+    total = 0
+    with gzip.open(path, 'wt', encoding='utf8', compresslevel=SNAPSHOT_COMPRESS_LEVEL) as file:
+        async for obj in iter_objs():
+            item = dynamo_encode_item(obj)
+            file.write(format_json(item, ensure_ascii=False) + '\n')
+            total += 1
+
+    log.info(json_msg(task='export', table=name, total=total))
+
+
+def read_chunks(path, cls, size=SNAPSHOT_CHUNK_SIZE):
+    chunk = []
+    with gzip.open(path, 'rt', encoding='utf8') as file:
+        for line in file:
+            chunk.append(dynamo_decode_item(parse_json(line), cls))
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+async def import_table(db, dir, name):
+    cls, _, put_objs = snapshot_table(db, name)
+    path = snapshot_path(dir, name)
+
+    total, failed = 0, 0
+    for chunk in read_chunks(path, cls):
+        failed += await put_objs(chunk) or 0
+        total += len(chunk)
+
+    log.info(json_msg(task='import', table=name, total=total, failed=failed))
+
+
+async def export_snapshot(context, dir, tables=SNAPSHOT_TABLES):
+    Path(dir).mkdir(parents=True, exist_ok=True)
+    for name in tables:
+        await export_table(context.db, dir, name)
+
+
+async def import_snapshot(context, dir, tables=SNAPSHOT_TABLES):
+    for name in tables:
+        await import_table(context.db, dir, name)
@@ -0,0 +1,655 @@
+# Local backend with the same API as DB. Run ops, benchmarks, load
+# tests offline on realistic data volumes. Same item format as Dynamo:
+# dynamo_encode_item stored as JSON, key attributes in indexed
+# columns. Projections are applied after read, same result as
+# ProjectionExpression.
+#
+# Stdlib sqlite3 is sync, calls block event loop for a few
+# microseconds, ok for local runs
+
+
+import sqlite3
+from contextlib import asynccontextmanager
+from json import (
+    loads as parse_json,
+    dumps as format_json
+)
+
+from .obj import (
+    Chat,
+    Contact,
+    User,
+    Match,
+    Progress,
+)
+from .history import merge_pair_histories
+from .const import (
+    CHATS_TABLE,
+    USERS_TABLE,
+    CONTACTS_TABLE,
+    MANUAL_MATCHES_TABLE,
+    PAIR_HISTORY_TABLE,
+    PROGRESS_TABLE,
+    CONTACTS_ARCHIVE_TABLE,
+
+    USER_KEY_FIELDS,
+    CONTACT_KEY_FIELDS,
+)
+from .dynamo import (
+    dynamo_decode_item,
+    dynamo_encode_item,
+    dynamo_encode_fields,
+    dynamo_serialize_key,
+)
+from .db import (
+    projection_fields,
+    format_archive_contacts,
+    parse_archive_contacts,
+    decode_pair_history,
+    pair_history_update_attrs,
+)
+
+
+# https://www.sqlite.org/wal.html
+# WAL: readers do not block writer. synchronous=NORMAL is safe with
+# WAL, fsync only on checkpoint
+
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+]
+
+# Contacts primary key is (week_index, key), week reads use prefix of
+# the index, same as Query on week partition
+
+SQLITE_SCHEMA = [
+    f'CREATE TABLE IF NOT EXISTS {CHATS_TABLE} (id INTEGER PRIMARY KEY, item TEXT)',
+    f'CREATE TABLE IF NOT EXISTS {USERS_TABLE} (user_id INTEGER PRIMARY KEY, item TEXT)',
+    (
+        f'CREATE TABLE IF NOT EXISTS {CONTACTS_TABLE} '
+        '(week_index INTEGER, key TEXT, item TEXT, PRIMARY KEY (week_index, key))'
+    ),
+    f'CREATE TABLE IF NOT EXISTS {MANUAL_MATCHES_TABLE} (key TEXT PRIMARY KEY, item TEXT)',
+    f'CREATE TABLE IF NOT EXISTS {PAIR_HISTORY_TABLE} (key TEXT PRIMARY KEY, item TEXT)',
+    f'CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE} (key TEXT PRIMARY KEY, item TEXT)',
+    f'CREATE TABLE IF NOT EXISTS {CONTACTS_ARCHIVE_TABLE} (week_index INTEGER PRIMARY KEY, data BLOB)',
+]
+
+# SQLITE_MAX_VARIABLE_NUMBER is 999 in older builds
+SQLITE_BATCH_SIZE = 500
+SQLITE_PAGE_SIZE = 1000
+
+
+#######
+#
+#   ITEM
+#
+#####
+
+
+def format_item(item):
+    return format_json(item, ensure_ascii=False)
+
+
+def parse_item(data, fields=None):
+    item = parse_json(data)
+    if fields:
+        item = {
+            _: item[_]
+            for _ in fields
+            if _ in item
+        }
+    return item
+
+
+def update_item(item, attrs):
+    for name, value in attrs.items():
+        if value is None:
+            item.pop(name, None)
+        else:
+            item[name] = value
+
+
+def contact_row(contact):
+    week_index, *user_ids = contact.key
+    return (
+        week_index,
+        dynamo_serialize_key(user_ids),
+        format_item(dynamo_encode_item(contact))
+    )
+
+
+def contact_row_key(key):
+    week_index, *user_ids = key
+    return (week_index, dynamo_serialize_key(user_ids))
+
+
+def manual_match_row_key(key):
+    return dynamo_serialize_key(key)
+
+
+def pair_history_row_key(key):
+    return dynamo_serialize_key(key)
+
+
+#######
+#
+#   OPS
+#
+######
+
+
+def sqlite_get(db, table, where, params, fields=None):
+    row = db.conn.execute(
+        f'SELECT item FROM {table} WHERE {where}',
+        params
+    ).fetchone()
+    if row:
+        return parse_item(row[0], fields)
+
+
+def sqlite_iter(db, table, where=None, params=(), fields=None):
+    query = f'SELECT item FROM {table}'
+    if where:
+        query += f' WHERE {where}'
+
+    cursor = db.conn.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(SQLITE_PAGE_SIZE)
+        if not rows:
+            break
+        for row, in rows:
+            yield parse_item(row, fields)
+
+
+def sqlite_get_many(db, table, column, ids, fields=None):
+    for index in range(0, len(ids), SQLITE_BATCH_SIZE):
+        batch = ids[index:index + SQLITE_BATCH_SIZE]
+        marks = ', '.join('?' for _ in batch)
+        yield from sqlite_iter(
+            db, table,
+            f'{column} IN ({marks})', batch,
+            fields=fields
+        )
+
+
+def sqlite_put_many(db, table, rows):
+    rows = list(rows)
+    if rows:
+        marks = ', '.join('?' for _ in rows[0])
+        with db.conn:
+            db.conn.executemany(
+                f'INSERT OR REPLACE INTO {table} VALUES ({marks})',
+                rows
+            )
+    return 0
+
+
+def sqlite_delete_many(db, table, where, params):
+    with db.conn:
+        db.conn.executemany(
+            f'DELETE FROM {table} WHERE {where}',
+            params
+        )
+    return 0
+
+
+# Same as dynamo_update: missing item is not created, return None
+
+
+def sqlite_update(db, table, where, params, attrs):
+    with db.conn:
+        item = sqlite_get(db, table, where, params)
+        if item is None:
+            return
+
+        update_item(item, attrs)
+        db.conn.execute(
+            f'UPDATE {table} SET item = ? WHERE {where}',
+            (format_item(item), *params)
+        )
+    return item
+
+
+#######
+#
+#   CHATS
+#
+#######
+
+
+async def get_chat(db, id):
+    item = sqlite_get(db, CHATS_TABLE, 'id = ?', (id,))
+    if item:
+        return dynamo_decode_item(item, Chat)
+
+
+async def iter_chats(db):
+    for item in sqlite_iter(db, CHATS_TABLE):
+        yield dynamo_decode_item(item, Chat)
+
+
+async def put_chats(db, chats):
+    return sqlite_put_many(
+        db, CHATS_TABLE,
+        (
+            (_.id, format_item(dynamo_encode_item(_)))
+            for _ in chats
+        )
+    )
+
+
+async def put_chat(db, chat):
+    await put_chats(db, [chat])
+
+
+async def delete_chat(db, id):
+    sqlite_delete_many(db, CHATS_TABLE, 'id = ?', [(id,)])
+
+
+######
+#
+#   USERS
+#
+#######
+
+
+async def get_user(db, user_id, fields=None):
+    item = sqlite_get(
+        db, USERS_TABLE,
+        'user_id = ?', (user_id,),
+        fields=projection_fields(fields, USER_KEY_FIELDS)
+    )
+    if item:
+        return dynamo_decode_item(item, User)
+
+
+async def get_users(db, user_ids, fields=None):
+    user_ids = list(user_ids)
+    items = sqlite_get_many(
+        db, USERS_TABLE, 'user_id',
+        list(set(user_ids)),
+        fields=projection_fields(fields, USER_KEY_FIELDS)
+    )
+    id_users = {}
+    for item in items:
+        user = dynamo_decode_item(item, User)
+        id_users[user.user_id] = user
+    return [id_users.get(_) for _ in user_ids]
+
+
+async def iter_users(db, filter=None, fields=None):
+    items = sqlite_iter(
+        db, USERS_TABLE,
+        fields=projection_fields(fields, USER_KEY_FIELDS)
+    )
+    for item in items:
+        user = dynamo_decode_item(item, User)
+        if not filter or filter(user):
+            yield user
+
+
+async def read_users(db, fields=None):
+    return [_ async for _ in iter_users(db, fields=fields)]
+
+
+async def put_users(db, users):
+    return sqlite_put_many(
+        db, USERS_TABLE,
+        (
+            (_.user_id, format_item(dynamo_encode_item(_)))
+            for _ in users
+        )
+    )
+
+
+async def delete_users(db, user_ids):
+    return sqlite_delete_many(
+        db, USERS_TABLE, 'user_id = ?',
+        ((_,) for _ in user_ids)
+    )
+
+
+async def put_user(db, user):
+    await put_users(db, [user])
+
+
+async def update_user(db, user_id, **fields):
+    item = sqlite_update(
+        db, USERS_TABLE,
+        'user_id = ?', (user_id,),
+        dynamo_encode_fields(User, fields)
+    )
+    if item:
+        return dynamo_decode_item(item, User)
+
+
+async def update_users(db, user_id_fields):
+    return [
+        await update_user(db, user_id, **fields)
+        for user_id, fields in user_id_fields
+    ]
+
+
+async def delete_user(db, user_id):
+    await delete_users(db, [user_id])
+
+
+#######
+#
+#   CONTACTS
+#
+#####
+
+
+CONTACT_WHERE = 'week_index = ? AND key = ?'
+
+
+async def get_contact(db, key, fields=None):
+    item = sqlite_get(
+        db, CONTACTS_TABLE,
+        CONTACT_WHERE, contact_row_key(key),
+        fields=projection_fields(fields, CONTACT_KEY_FIELDS)
+    )
+    if item:
+        return dynamo_decode_item(item, Contact)
+
+
+async def get_contacts(db, keys, fields=None):
+    return [
+        await get_contact(db, _, fields=fields)
+        for _ in keys
+    ]
+
+
+async def iter_contacts(db, filter=None, fields=None):
+    items = sqlite_iter(
+        db, CONTACTS_TABLE,
+        fields=projection_fields(fields, CONTACT_KEY_FIELDS)
+    )
+    for item in items:
+        contact = dynamo_decode_item(item, Contact)
+        if not filter or filter(contact):
+            yield contact
+
+
+async def read_contacts(db, fields=None):
+    return [_ async for _ in iter_contacts(db, fields=fields)]
+
+
+async def iter_week_contacts(db, week_index, fields=None):
+    items = sqlite_iter(
+        db, CONTACTS_TABLE,
+        'week_index = ?', (week_index,),
+        fields=projection_fields(fields, CONTACT_KEY_FIELDS)
+    )
+    for item in items:
+        yield dynamo_decode_item(item, Contact)
+
+
+async def read_week_contacts(db, week_index, fields=None):
+    return [
+        _ async for _ in
+        iter_week_contacts(db, week_index, fields=fields)
+    ]
+
+
+async def put_contacts(db, contacts):
+    return sqlite_put_many(
+        db, CONTACTS_TABLE,
+        (contact_row(_) for _ in contacts)
+    )
+
+
+async def delete_contacts(db, keys):
+    return sqlite_delete_many(
+        db, CONTACTS_TABLE, CONTACT_WHERE,
+        (contact_row_key(_) for _ in keys)
+    )
+
+
+async def put_contact(db, contact):
+    await put_contacts(db, [contact])
+
+
+async def update_contact(db, key, **fields):
+    item = sqlite_update(
+        db, CONTACTS_TABLE,
+        CONTACT_WHERE, contact_row_key(key),
+        dynamo_encode_fields(Contact, fields)
+    )
+    if item:
+        return dynamo_decode_item(item, Contact)
+
+
+async def delete_contact(db, key):
+    await delete_contacts(db, [key])
+
+
+# Local commit is fast, one pass, no chunks
+
+
+async def commit_contacts(db, key, groups):
+    for contacts, user_partner_ids in groups:
+        await put_contacts(db, contacts)
+        await update_users(db, (
+            (user_id, {'partner_user_id': partner_user_id})
+            for user_id, partner_user_id in user_partner_ids.items()
+        ))
+    return 0
+
+
+#######
+#
+#   CONTACTS ARCHIVE
+#
+######
+
+
+async def read_archive_contacts(db):
+    rows = db.conn.execute(
+        f'SELECT week_index, data FROM {CONTACTS_ARCHIVE_TABLE}'
+    )
+    contacts = []
+    for week_index, data in rows:
+        contacts.extend(parse_archive_contacts(week_index, data))
+    return contacts
+
+
+async def put_archive_week(db, week_index, contacts):
+    data = format_archive_contacts(contacts)
+    sqlite_put_many(db, CONTACTS_ARCHIVE_TABLE, [(week_index, data)])
+
+
+#######
+#
+#    MANUAL MATCHES
+#
+######
+
+
+async def iter_manual_matches(db):
+    for item in sqlite_iter(db, MANUAL_MATCHES_TABLE):
+        yield dynamo_decode_item(item, Match)
+
+
+async def read_manual_matches(db):
+    return [_ async for _ in iter_manual_matches(db)]
+
+
+async def put_manual_matches(db, matches):
+    return sqlite_put_many(
+        db, MANUAL_MATCHES_TABLE,
+        (
+            (
+                manual_match_row_key(_.key),
+                format_item(dynamo_encode_item(_))
+            )
+            for _ in matches
+        )
+    )
+
+
+async def delete_manual_matches(db, keys):
+    return sqlite_delete_many(
+        db, MANUAL_MATCHES_TABLE, 'key = ?',
+        ((manual_match_row_key(_),) for _ in keys)
+    )
+
+
+async def put_manual_match(db, match):
+    await put_manual_matches(db, [match])
+
+
+async def delete_manual_match(db, key):
+    await delete_manual_matches(db, [key])
+
+
+#######
+#
+#    PAIR HISTORY
+#
+######
+
+
+async def get_pair_histories(db, keys):
+    keys = list(keys)
+    items = sqlite_get_many(
+        db, PAIR_HISTORY_TABLE, 'key',
+        [pair_history_row_key(_) for _ in keys]
+    )
+    key_histories = {}
+    for item in items:
+        history = decode_pair_history(item)
+        if history:
+            key_histories[history.key] = history
+    return [key_histories.get(tuple(_)) for _ in keys]
+
+
+async def iter_pair_histories(db):
+    for item in sqlite_iter(db, PAIR_HISTORY_TABLE):
+        history = decode_pair_history(item)
+        if history:
+            yield history
+
+
+async def read_pair_histories(db):
+    return [_ async for _ in iter_pair_histories(db)]
+
+
+# Read and write without await in between, same as UpdateItem: no
+# other merge interleaves
+
+
+async def update_pair_sides(db, key_sides):
+    rows = []
+    for key, sides in key_sides.items():
+        row_key = pair_history_row_key(key)
+        item = sqlite_get(db, PAIR_HISTORY_TABLE, 'key = ?', (row_key,)) or {}
+        update_item(item, pair_history_update_attrs(key, sides))
+        rows.append((row_key, format_item(item)))
+    return sqlite_put_many(db, PAIR_HISTORY_TABLE, rows)
+
+
+#######
+#
+#    PROGRESS
+#
+######
+
+
+async def get_progress(db, key):
+    item = sqlite_get(db, PROGRESS_TABLE, 'key = ?', (key,))
+    if item:
+        return dynamo_decode_item(item, Progress)
+
+
+async def put_progress(db, progress):
+    sqlite_put_many(
+        db, PROGRESS_TABLE,
+        [(progress.key, format_item(dynamo_encode_item(progress)))]
+    )
+
+
+######
+#
+#  DB
+#
+#######
+
+
+# Local writes are cheap, nothing to buffer, same API as DB.session
+
+
+@asynccontextmanager
+async def session(db):
+    yield
+
+
+class SqliteDB:
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+
+    async def connect(self):
+        self.conn = sqlite3.connect(self.path)
+        for query in SQLITE_PRAGMAS + SQLITE_SCHEMA:
+            self.conn.execute(query)
+
+    async def close(self):
+        self.conn.close()
+
+    def cache_stats(self):
+        return {}
+
+
+SqliteDB.session = session
+
+SqliteDB.iter_chats = iter_chats
+SqliteDB.put_chats = put_chats
+SqliteDB.put_chat = put_chat
+SqliteDB.delete_chat = delete_chat
+SqliteDB.get_chat = get_chat
+
+SqliteDB.get_user = get_user
+SqliteDB.get_users = get_users
+SqliteDB.iter_users = iter_users
+SqliteDB.read_users = read_users
+SqliteDB.put_user = put_user
+SqliteDB.update_user = update_user
+SqliteDB.update_users = update_users
+SqliteDB.delete_user = delete_user
+SqliteDB.put_users = put_users
+SqliteDB.delete_users = delete_users
+
+SqliteDB.get_contact = get_contact
+SqliteDB.get_contacts = get_contacts
+SqliteDB.iter_contacts = iter_contacts
+SqliteDB.read_contacts = read_contacts
+SqliteDB.iter_week_contacts = iter_week_contacts
+SqliteDB.read_week_contacts = read_week_contacts
+SqliteDB.put_contact = put_contact
+SqliteDB.update_contact = update_contact
+SqliteDB.delete_contact = delete_contact
+SqliteDB.put_contacts = put_contacts
+SqliteDB.delete_contacts = delete_contacts
+SqliteDB.commit_contacts = commit_contacts
+
+SqliteDB.read_archive_contacts = read_archive_contacts
+SqliteDB.put_archive_week = put_archive_week
+
+SqliteDB.iter_manual_matches = iter_manual_matches
+SqliteDB.read_manual_matches = read_manual_matches
+SqliteDB.put_manual_match = put_manual_match
+SqliteDB.delete_manual_match = delete_manual_match
+SqliteDB.put_manual_matches = put_manual_matches
+SqliteDB.delete_manual_matches = delete_manual_matches
+
+SqliteDB.get_pair_histories = get_pair_histories
+SqliteDB.iter_pair_histories = iter_pair_histories
+SqliteDB.read_pair_histories = read_pair_histories
+SqliteDB.update_pair_sides = update_pair_sides
+SqliteDB.merge_pair_histories = merge_pair_histories
+
+SqliteDB.get_progress = get_progress
+SqliteDB.put_progress = put_progress
@@ -0,0 +1,73 @@
+# Counters of Dynamo requests per (table, op): calls, latency, items,
+# scan/query pages, retries (ours + botocore), consumed capacity units.
+# Every request is recorded in process wide STATS and in scope stats
+# if any. Bot middleware and trigger open scope per update/task, log
+# it on exit
+
+
+from dataclasses import (
+    dataclass,
+    asdict
+)
+from collections import defaultdict
+from contextvars import ContextVar
+from contextlib import contextmanager
+
+
+@dataclass
+class OpStats:
+    calls: int = 0
+    errors: int = 0
+    seconds: float = 0
+    items: int = 0
+    pages: int = 0
+    retries: int = 0
+    units: float = 0
+
+
+class Stats:
+    def __init__(self):
+        self.ops = defaultdict(OpStats)
+
+    def record(self, table, op, **values):
+        stats = self.ops[table, op]
+        for name, value in values.items():
+            setattr(stats, name, getattr(stats, name) + value)
+
+    def get(self, table, op):
+        return self.ops.get((table, op)) or OpStats()
+
+    def reset(self):
+        self.ops.clear()
+
+    def summary(self):
+        return [
+            {
+                'table': table,
+                'op': op,
+                **asdict(stats),
+                'seconds': round(stats.seconds, 4),
+            }
+            for (table, op), stats in sorted(self.ops.items())
+        ]
+
+
+STATS = Stats()
+SCOPE_STATS = ContextVar('scope_stats', default=None)
+
+
+def record_stats(table, op, **values):
+    STATS.record(table, op, **values)
+    stats = SCOPE_STATS.get()
+    if stats:
+        stats.record(table, op, **values)
+
+
+@contextmanager
+def stats_scope():
+    stats = Stats()
+    token = SCOPE_STATS.set(stats)
+    try:
+        yield stats
+    finally:
+        SCOPE_STATS.reset(token)
@@ -1,4 +1,5 @@
 
+import asyncio
 from json import (
     loads as parse_json,
     dumps as format_json
@@ -8,15 +9,18 @@ from aiogram.types import Update
 
 from neludim.bot.bot import (
     Bot,
+    BaseDispatcher,
     Dispatcher,
     setup_bot,
 )
 from neludim.bot.broadcast import Broadcast
+from neludim.bot.storage import ChatStorage
 from neludim.schedule import (
     Schedule,
     START_DATE,
 )
 from neludim.db import DB
+from neludim.history import parse_pair_history
 from neludim.context import Context
 
 
@@ -34,10 +38,13 @@ class FakeBot(Bot):
 class FakeDB(DB):
     def __init__(self):
         DB.__init__(self)
-        self.chat_states = {}
+        self.chats = {}
         self.users = []
         self.contacts = []
         self.manual_matches = []
+        self.pair_sides = {}
+        self.progress = {}
+        self.archive_contacts = []
 
     async def connect(self):
         pass
@@ -45,27 +52,48 @@ class FakeDB(DB):
     async def close(self):
         pass
 
-    async def set_chat_state(self, id, state):
-        self.chat_states[id] = state
+    async def get_chat(self, id):
+        return self.chats.get(id)
 
-    async def reset_chat_state(self, id):
-        await self.set_chat_state(id, state=None)
+    async def put_chat(self, chat):
+        self.chats[chat.id] = chat
 
-    async def get_chat_state(self, id):
-        return self.chat_states.get(id)
+    async def delete_chat(self, id):
+        self.chats.pop(id, None)
 
-    async def get_user(self, user_id):
+    async def get_user(self, user_id, fields=None):
         for user in self.users:
             if user.user_id == user_id:
                 return user
 
-    async def read_users(self):
+    async def get_users(self, user_ids, fields=None):
+        return [await self.get_user(_) for _ in user_ids]
+
+    async def iter_users(self, filter=None, fields=None):
+        for user in self.users:
+            if not filter or filter(user):
+                yield user
+
+    async def read_users(self, fields=None):
         return self.users
 
     async def put_user(self, user):
         await self.delete_user(user.user_id)
         self.users.append(user)
 
+    async def update_user(self, user_id, **fields):
+        user = await self.get_user(user_id)
+        if user:
+            for name, value in fields.items():
+                setattr(user, name, value)
+            return user
+
+    async def update_users(self, user_id_fields):
+        return [
+            await self.update_user(user_id, **fields)
+            for user_id, fields in user_id_fields
+        ]
+
     async def delete_user(self, user_id):
         self.users = [
             _ for _ in self.users
@@ -80,18 +108,44 @@ class FakeDB(DB):
         for user in users:
             await self.delete_user(user)
 
-    async def get_contact(self, key):
+    async def get_contact(self, key, fields=None):
         for contact in self.contacts:
             if contact.key == key:
                 return contact
 
-    async def read_contacts(self):
+    async def get_contacts(self, keys, fields=None):
+        return [await self.get_contact(_) for _ in keys]
+
+    async def iter_contacts(self, filter=None, fields=None):
+        for contact in self.contacts:
+            if not filter or filter(contact):
+                yield contact
+
+    async def read_contacts(self, fields=None):
         return self.contacts
 
+    async def iter_week_contacts(self, week_index, fields=None):
+        for contact in self.contacts:
+            if contact.week_index == week_index:
+                yield contact
+
+    async def read_week_contacts(self, week_index, fields=None):
+        return [
+            _ async for _ in
+            self.iter_week_contacts(week_index)
+        ]
+
     async def put_contact(self, contact):
         await self.delete_contact(contact.key)
         self.contacts.append(contact)
 
+    async def update_contact(self, key, **fields):
+        contact = await self.get_contact(key)
+        if contact:
+            for name, value in fields.items():
+                setattr(contact, name, value)
+            return contact
+
     async def delete_contact(self, key):
         self.contacts = [
             _ for _ in self.contacts
@@ -106,6 +160,25 @@ class FakeDB(DB):
         for contact in contacts:
             await self.delete_contact(contact)
 
+    async def commit_contacts(self, key, groups):
+        for contacts, user_partner_ids in groups:
+            await self.put_contacts(contacts)
+            await self.update_users(
+                (user_id, {'partner_user_id': partner_user_id})
+                for user_id, partner_user_id in user_partner_ids.items()
+            )
+        return 0
+
+    async def read_archive_contacts(self):
+        return self.archive_contacts
+
+    async def put_archive_week(self, week_index, contacts):
+        self.archive_contacts = [
+            _ for _ in self.archive_contacts
+            if _.week_index != week_index
+        ]
+        self.archive_contacts.extend(contacts)
+
     async def read_manual_matches(self):
         return self.manual_matches
 
@@ -119,6 +192,30 @@ class FakeDB(DB):
             if _.key != key
         ]
 
+    async def read_pair_histories(self):
+        return [
+            parse_pair_history(key, sides)
+            for key, sides in self.pair_sides.items()
+        ]
+
+    async def update_pair_sides(self, key_sides):
+        for key, sides in key_sides.items():
+            self.pair_sides.setdefault(key, {}).update(sides)
+        return 0
+
+    async def get_pair_histories(self, keys):
+        return [
+            parse_pair_history(tuple(_), self.pair_sides[tuple(_)])
+            if tuple(_) in self.pair_sides else None
+            for _ in keys
+        ]
+
+    async def get_progress(self, key):
+        return self.progress.get(key)
+
+    async def put_progress(self, progress):
+        self.progress[progress.key] = progress
+
 
 class FakeSchedule(Schedule):
     date = START_DATE
@@ -131,9 +228,12 @@ class FakeContext(Context):
     def __init__(self):
         Context.__init__(self)
         self.bot = FakeBot()
-        self.dispatcher = Dispatcher(self.bot)
-        self.broadcast = Broadcast(self.bot)
         self.db = FakeDB()
+        self.dispatcher = Dispatcher(
+            self.bot,
+            storage=ChatStorage(self.db)
+        )
+        self.broadcast = Broadcast(self.bot)
         self.schedule = FakeSchedule()
 
 
@@ -141,13 +241,20 @@ def fake_setup(context):
     setup_bot(context)
 
     Bot.set_current(context.bot)
-    Dispatcher.set_current(context.dispatcher)
+    # aiogram reads current dispatcher from base class context var,
+    # same as webhook
+    BaseDispatcher.set_current(context.dispatcher)
 
 
 async def process_update(context, json):
     data = parse_json(json)
     update = Update(**data)
-    await context.dispatcher.process_update(update)
+
+    # Webhook processes every update in separate task, aiogram keeps
+    # per update state in context vars, see StateFilter.ctx_state
+    await asyncio.create_task(
+        context.dispatcher.process_update(update)
+    )
 
 
 def match_trace(trace, etalon):
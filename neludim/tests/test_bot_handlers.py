@@ -201,6 +201,9 @@ async def test_feedback(context):
         ['sendMessage', 'Все круто']
     ])
     assert context.db.contacts[0].feedback_text == 'Все круто'
+    assert 1 not in context.db.chats
+    [history] = await context.db.get_pair_histories([(1, 2)])
+    assert history.feedback_score == 'great'
 
 
 async def test_bad_feedback(context):
@@ -225,6 +228,16 @@ async def test_fail_feedback(context):
     ])
 
 
+async def test_archived_feedback(context):
+    context.db.users = [User(user_id=1, partner_user_id=2)]
+    await process_update(context, query_json('feedback:0:2:confirm:great'))
+
+    assert match_trace(context.bot.trace, [
+        ['answerCallbackQuery', '{"callback_query_id": "1"}'],
+    ])
+    assert await context.db.read_pair_histories() == []
+
+
 async def test_cancel_feedback(context):
     await process_update(context, query_json('cancel_feedback'))
 
@@ -4,6 +4,7 @@ from neludim.tests.fake import match_trace
 from neludim.obj import (
     User,
     Contact,
+    PairHistory,
 )
 from neludim.schedule import week_index_monday
 
@@ -13,7 +14,9 @@ from neludim.bot.ops import (
     send_contacts,
     ask_feedback,
     manual_match,
-    send_reports
+    send_reports,
+    read_contacts_history,
+    archive_contacts,
 )
 
 
@@ -40,6 +43,30 @@ async def test_create_contacts(context):
         Contact(week_index=0, user_id=3, partner_user_id=2),
         Contact(week_index=0, user_id=1, partner_user_id=None),
     ]
+    assert [_.partner_user_id for _ in context.db.users] == [None, 3, 2]
+    assert await context.db.read_pair_histories() == [
+        PairHistory(user_id=2, partner_user_id=3, week_index=0)
+    ]
+
+
+async def test_create_contacts_deleted_user(context):
+    agreed_participate = week_index_monday(context.schedule.current_week_index() - 1)
+    context.db.users = [
+        User(user_id=1, agreed_participate=agreed_participate),
+        User(user_id=2, agreed_participate=agreed_participate),
+    ]
+    users = context.db.users[:]
+
+    # User 2 is deleted between reads
+    async def read_users(fields=None):
+        context.db.users = users[:1]
+        return users
+
+    context.db.read_users = read_users
+    await create_contacts(context)
+    assert context.db.contacts == [
+        Contact(week_index=0, user_id=1, partner_user_id=None),
+    ]
 
 
 async def test_send_contacts(context):
@@ -94,3 +121,20 @@ async def test_manual_match(context):
 
 async def test_send_reports(context):
     await send_reports(context)
+
+
+async def test_archive_contacts(context):
+    context.schedule.date = week_index_monday(30)
+    context.db.contacts = [
+        Contact(week_index=0, user_id=1, partner_user_id=2, state='confirm'),
+        Contact(week_index=0, user_id=2, partner_user_id=1),
+        Contact(week_index=29, user_id=1, partner_user_id=2),
+    ]
+    history = await read_contacts_history(context)
+
+    await archive_contacts(context)
+    assert context.db.contacts == [
+        Contact(week_index=29, user_id=1, partner_user_id=2),
+    ]
+    assert context.db.archive_contacts == history[:2]
+    assert history == await read_contacts_history(context)
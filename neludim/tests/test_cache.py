@@ -0,0 +1,42 @@
+
+from neludim.cache import (
+    TTLCache,
+    MISSING
+)
+
+
+class Timer:
+    now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache():
+    timer = Timer()
+    cache = TTLCache(maxsize=2, ttl=10, timer=timer)
+
+    cache.set(1, 'a')
+    cache.set(2, None)
+    assert cache.get(1) == 'a'
+    assert cache.get(2) is None
+    assert cache.get(3) is MISSING
+
+    # 1 is recently used, 2 is evicted
+    cache.get(1)
+    cache.set(3, 'c')
+    assert cache.get(2) is MISSING
+    assert cache.get(1) == 'a'
+
+    timer.now = 11
+    assert cache.get(1) is MISSING
+    assert len(cache) == 1
+
+    assert cache.stats() == {'size': 1, 'hits': 4, 'misses': 3}
+
+
+def test_cache_off():
+    cache = TTLCache(maxsize=2, ttl=0)
+    cache.set(1, 'a')
+    assert cache.get(1) is MISSING
+    assert len(cache) == 0
@@ -1,14 +1,53 @@
 
+import asyncio
+
+import pytest
+
+from aiogram.types import Update
+
+import neludim.db
+from neludim.const import (
+    CONTACTS_TABLE,
+    CHAT_STATE_TTL,
+)
+from neludim.migrate import migrate_chat_expires
+from neludim.stats import stats_scope
+from neludim.cache import (
+    TTLCache,
+    MISSING
+)
+from neludim.bot.bot import (
+    Bot,
+    Dispatcher,
+)
+from neludim.bot.storage import ChatStorage
 from neludim.obj import (
+    Chat,
     User,
     Contact,
-    Match
+    Match,
+    PairHistory,
+    Progress
 )
 
 
 async def test_chats(db):
-    await db.set_chat_state(1, '2')
-    assert '2' == await db.get_chat_state(1)
+    storage = ChatStorage(db, ttl=10, timer=lambda: 0)
+    await storage.set_state(chat=1, state='a')
+    await storage.update_data(chat=1, b=2)
+    assert 'a' == await storage.get_state(chat=1)
+    assert {'b': 2} == await storage.get_data(chat=1)
+
+    chat = Chat(1, 'a', '{"b": 2}', expires=10)
+    assert chat == await db.get_chat(1)
+    assert chat in [_ async for _ in db.iter_chats()]
+
+    storage.timer = lambda: 20
+    assert await storage.get_state(chat=1) is None
+
+    storage.timer = lambda: 0
+    await storage.finish(chat=1)
+    assert await db.get_chat(1) is None
 
 
 async def test_users(db):
@@ -21,10 +60,58 @@ async def test_users(db):
     assert user == await db.get_user(user_id=user.user_id)
     assert user in await db.read_users()
 
+    assert [user, None] == await db.get_users([user.user_id, 2])
+    assert User(user_id=1) in await db.read_users(fields=['user_id'])
+    assert user == await db.get_user(user.user_id, fields=['name'])
+
+    user = await db.update_user(user.user_id, name='def', city='Москва')
+    assert user == User(user_id=1, name='def', city='Москва')
+    assert await db.update_user(2, name='def') is None
+
     await db.delete_user(user_id=user.user_id)
     assert await db.get_user(user_id=user.user_id) is None
 
 
+async def test_user_cache(db):
+    db.user_cache = TTLCache(maxsize=10, ttl=60)
+    user = User(user_id=1, name='abc')
+
+    await db.put_user(user)
+    hits = db.user_cache.hits
+    assert user == await db.get_user(user.user_id)
+    assert user == await db.get_user(user.user_id, fields=['name'])
+    assert [user, None] == await db.get_users([user.user_id, 2])
+    assert db.user_cache.hits == hits + 3
+
+    await db.update_user(user.user_id, city='Москва')
+    assert 'Москва' == (await db.get_user(user.user_id)).city
+
+    await db.delete_user(user.user_id)
+    assert await db.get_user(user.user_id) is None
+
+
+async def test_user_cache_session(db, monkeypatch):
+    db.user_cache = TTLCache(maxsize=10, ttl=60)
+    user = User(user_id=1, name='abc')
+
+    async with db.session():
+        await db.put_user(user)
+        assert db.user_cache.get(user.user_id) is MISSING
+    assert db.user_cache.get(user.user_id) is not MISSING
+
+    async def dynamo_batch_write(client, table, requests, **kwargs):
+        return len(list(requests))
+
+    monkeypatch.setattr(neludim.db, 'dynamo_batch_write', dynamo_batch_write)
+    with pytest.raises(neludim.db.SessionFlushError):
+        async with db.session():
+            await db.put_user(user)
+    assert db.user_cache.get(user.user_id) is MISSING
+
+    monkeypatch.undo()
+    await db.delete_user(user.user_id)
+
+
 async def test_contacts(db):
     contact = Contact(
         week_index=0,
@@ -35,6 +122,17 @@ async def test_contacts(db):
     await db.put_contact(contact)
     assert contact == await db.get_contact(contact.key)
     assert contact in await db.read_contacts()
+    assert [contact] == [
+        _ async for _ in db.iter_contacts(
+            filter=lambda _: _.key == contact.key
+        )
+    ]
+
+    assert [contact] == await db.get_contacts([contact.key])
+    assert contact in await db.read_week_contacts(contact.week_index)
+
+    contact = await db.update_contact(contact.key, state='confirm')
+    assert contact.state == 'confirm'
 
     await db.delete_contact(contact.key)
     assert await db.get_contact(contact.key) is None
@@ -49,3 +147,168 @@ async def test_manual_matches(db):
     await db.put_manual_match(match)
     assert match in await db.read_manual_matches()
     await db.delete_manual_match(match.key)
+
+
+async def test_pair_histories(db):
+    async with db.session():
+        await db.merge_pair_histories([Contact(0, 2, 1), Contact(0, 3)])
+        await db.merge_pair_histories([Contact(1, 1, 2, state='confirm', feedback_score='ok')])
+    await db.merge_pair_histories([Contact(2, 2, 1, state='fail', feedback_score='great')])
+
+    history = PairHistory(1, 2, week_index=2, state='confirm', feedback_score='ok')
+    assert [history, None] == await db.get_pair_histories([(1, 2), (1, 3)])
+    assert history in await db.read_pair_histories()
+
+
+async def test_pair_histories_concurrent(db):
+    await asyncio.gather(
+        db.merge_pair_histories([Contact(0, 4, 5, state='confirm', feedback_score='great')]),
+        db.merge_pair_histories([Contact(0, 5, 4, state='confirm', feedback_score='bad')]),
+    )
+    history = PairHistory(4, 5, week_index=0, state='confirm', feedback_score='bad')
+    assert [history] == await db.get_pair_histories([(4, 5)])
+
+
+async def test_pair_histories_changed(db):
+    await db.merge_pair_histories([Contact(0, 6, 7, state='confirm', feedback_score='bad')])
+    await db.merge_pair_histories([Contact(0, 6, 7, state='fail')])
+
+    history = PairHistory(6, 7, week_index=0, state='fail')
+    assert [history] == await db.get_pair_histories([(6, 7)])
+
+
+async def test_session(db):
+    user = User(user_id=1, name='abc')
+    contact = Contact(week_index=0, user_id=1, partner_user_id=2)
+
+    async with db.session():
+        await db.put_user(user)
+        await db.put_contact(contact)
+        await db.put_chat(Chat(1, 'a'))
+        await db.put_chat(Chat(1))
+
+        assert user == await db.get_user(user.user_id)
+        assert user in await db.read_users()
+        assert contact in await db.read_week_contacts(contact.week_index)
+        assert await db.update_user(user.user_id, city='Москва')
+
+        await db.delete_contact(contact.key)
+        assert await db.get_contact(contact.key) is None
+
+    user.city = 'Москва'
+    assert user == await db.get_user(user.user_id)
+    assert Chat(1) == await db.get_chat(1)
+    assert await db.get_contact(contact.key) is None
+
+    await db.delete_user(user.user_id)
+
+
+async def test_session_reads(db):
+    contact = Contact(week_index=0, user_id=1, partner_user_id=2)
+    await db.put_contact(contact)
+
+    with stats_scope() as stats:
+        async with db.session():
+            assert contact == await db.get_contact(contact.key)
+            assert [contact] == await db.get_contacts([contact.key])
+            assert await db.get_contact((0, 1, 3)) is None
+            assert await db.get_contact((0, 1, 3)) is None
+
+            contact = await db.update_contact(contact.key, state='confirm')
+            assert contact == await db.get_contact(contact.key)
+
+    assert stats.get(CONTACTS_TABLE, 'get_item').calls == 2
+    assert stats.get(CONTACTS_TABLE, 'batch_get_item').calls == 0
+
+    await db.delete_contact(contact.key)
+
+
+async def test_session_flush_error(db, monkeypatch):
+    async def dynamo_batch_write(client, table, requests, **kwargs):
+        return len(list(requests))
+
+    monkeypatch.setattr(neludim.db, 'dynamo_batch_write', dynamo_batch_write)
+    with pytest.raises(neludim.db.SessionFlushError):
+        async with db.session():
+            await db.put_user(User(user_id=1))
+
+
+async def test_session_handler_error(db):
+    dispatcher = Dispatcher(
+        Bot('123:faketoken'),
+        storage=ChatStorage(db)
+    )
+
+    async def handler(message):
+        await db.put_contact(Contact(week_index=0, user_id=1))
+        raise ValueError('handler')
+
+    dispatcher.register_message_handler(handler)
+    update = Update(update_id=1, message={
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': 1, 'type': 'private'},
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'a'},
+        'text': 'a'
+    })
+    with pytest.raises(ValueError):
+        await dispatcher.process_update(update)
+
+    assert await db.get_contact((0, 1)) is None
+
+
+async def test_commit_contacts(db):
+    await db.put_users([User(user_id=1), User(user_id=2)])
+
+    # User 3 is missing, update is dropped, chunk is committed
+    groups = [
+        ([Contact(0, 1, 2), Contact(0, 2, 1)], {1: 2, 2: 1}),
+        ([Contact(0, 3)], {3: None}),
+    ]
+    assert 0 == await db.commit_contacts('test', groups)
+    assert 0 == await db.commit_contacts('test', groups)
+
+    user1, user2, user3 = await db.get_users([1, 2, 3])
+    assert (user1.partner_user_id, user2.partner_user_id, user3) == (2, 1, None)
+    assert len(await db.read_week_contacts(0)) == 3
+
+    await db.put_progress(Progress('test', data='[]'))
+    assert Progress('test', data='[]') == await db.get_progress('test')
+
+    await db.delete_users([1, 2])
+    await db.delete_contacts([(0, 1, 2), (0, 2, 1), (0, 3)])
+
+
+async def test_commit_contacts_canceled(db, monkeypatch):
+    # Canceled without reasons is not a commit
+    async def dynamo_transact_write(client, items, throttle=None):
+        return []
+
+    monkeypatch.setattr(neludim.db, 'dynamo_transact_write', dynamo_transact_write)
+    groups = [([Contact(0, 4)], {4: None})]
+    assert 1 == await db.commit_contacts('test_canceled', groups)
+
+
+class Context:
+    def __init__(self, db):
+        self.db = db
+
+
+async def test_migrate_chat_expires(db):
+    await db.put_chats([Chat(2, 'a'), Chat(3, 'b', expires=10)])
+    await migrate_chat_expires(Context(db), timer=lambda: 0)
+
+    assert Chat(2, 'a', expires=CHAT_STATE_TTL) == await db.get_chat(2)
+    assert Chat(3, 'b', expires=10) == await db.get_chat(3)
+
+    await db.delete_chat(2)
+    await db.delete_chat(3)
+
+
+async def test_archive_contacts(db):
+    contacts = [
+        Contact(week_index=0, user_id=1, partner_user_id=2, state='confirm', feedback_text='абв'),
+        Contact(week_index=0, user_id=3),
+    ]
+    await db.put_archive_week(0, contacts)
+    assert contacts == await db.read_archive_contacts()
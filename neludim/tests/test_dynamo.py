@@ -0,0 +1,80 @@
+from datetime import datetime as Datetime
+
+import pytest
+
+from neludim.obj import (
+    Chat,
+    User,
+    Contact,
+    Match
+)
+from neludim.dynamo import (
+    dynamo_serialize_item,
+    dynamo_deserialize_item,
+    dynamo_encode_item,
+    dynamo_decode_item,
+    dynamo_query_pages,
+    dynamo_batch_get,
+    DynamoUnprocessedKeys,
+)
+from neludim.stats import (
+    STATS,
+    stats_scope
+)
+
+
+def test_codec():
+    objs = [
+        Chat(id=1, state='edit_profile:name'),
+        User(
+            user_id=1,
+            name='abc',
+            created=Datetime(2022, 8, 15),
+            partner_user_id=2
+        ),
+        Contact(week_index=0, user_id=1, state='confirm'),
+        Match(user_id=1, partner_user_id=2),
+    ]
+    for obj in objs:
+        item = dynamo_encode_item(obj)
+        assert item == dynamo_serialize_item(obj)
+        assert obj == dynamo_decode_item(item, obj.__class__)
+        assert obj == dynamo_deserialize_item(item, obj.__class__)
+
+
+class FakeClient:
+    async def query(self, **params):
+        page = {
+            'Items': [{'user_id': {'N': '1'}}],
+            'ConsumedCapacity': {'CapacityUnits': 0.5},
+            'ResponseMetadata': {'RetryAttempts': 1},
+        }
+        if 'ExclusiveStartKey' not in params:
+            page['LastEvaluatedKey'] = {'user_id': {'N': '1'}}
+        return page
+
+
+async def test_stats():
+    STATS.reset()
+    with stats_scope() as stats:
+        pages = dynamo_query_pages(FakeClient(), 'users', 'user_id', 'N', 1)
+        assert 2 == len([_ async for _ in pages])
+
+    for stats in [stats, STATS]:
+        op = stats.get('users', 'query')
+        assert (op.calls, op.items, op.pages, op.retries, op.units) == (2, 2, 2, 2, 1)
+
+
+class ThrottledClient:
+    async def batch_get_item(self, RequestItems, **params):
+        return {
+            'Responses': {},
+            'UnprocessedKeys': RequestItems,
+            'ResponseMetadata': {},
+        }
+
+
+async def test_batch_get_unprocessed():
+    keys = [{'user_id': {'N': '1'}}]
+    with pytest.raises(DynamoUnprocessedKeys):
+        await dynamo_batch_get(ThrottledClient(), 'users', keys, attempts=2)
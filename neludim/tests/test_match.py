@@ -1,10 +1,28 @@
 
+import random
+
 from neludim.obj import (
     User,
     Match,
-    Contact
+    Contact,
+    PairHistory,
+)
+from neludim.const import (
+    CONFIRM_STATE,
+    FAIL_STATE,
+    BAD_SCORE,
+    GREAT_SCORE,
+
+    GREEDY_MATCH_ENGINE,
+    EXACT_MATCH_ENGINE,
+    AUTO_MATCH_ENGINE,
 )
-from neludim.match import gen_matches
+from neludim.match import (
+    gen_matches,
+    select_match_engine,
+    random_numerators,
+)
+from neludim.history import gen_pair_histories
 
 
 def test_even():
@@ -54,3 +72,88 @@ def test_skip():
         Match(user_id=2, partner_user_id=3),
         Match(user_id=1, partner_user_id=None),
     ]
+
+
+def test_parallel():
+    users = [User(user_id=_, city=str(_ % 3)) for _ in range(20)]
+    assert (
+        list(gen_matches(users, rounds=20, workers=2))
+        == list(gen_matches(users, rounds=20, workers=0))
+    )
+
+
+def test_exact_path():
+    # Only 0-1, 1-2, 2-3 allowed, see neludim.match
+    users = [User(user_id=_) for _ in range(4)]
+    contacts = [
+        Contact(1, 0, 2),
+        Contact(1, 0, 3),
+        Contact(1, 1, 3),
+    ]
+    matches = list(gen_matches(
+        users, contacts=contacts, current_week_index=2,
+        engine=EXACT_MATCH_ENGINE
+    ))
+    assert matches == [
+        Match(user_id=0, partner_user_id=1),
+        Match(user_id=2, partner_user_id=3),
+    ]
+
+
+def test_exact_manual():
+    users = [User(user_id=_) for _ in range(5)]
+    manual_matches = [
+        Match(0, 2),
+        Match(1, 2),
+        Match(1, 4)
+    ]
+    matches = list(gen_matches(
+        users, manual_matches=manual_matches,
+        engine=EXACT_MATCH_ENGINE
+    ))
+    assert matches == [
+        Match(user_id=0, partner_user_id=2),
+        Match(user_id=1, partner_user_id=4),
+        Match(user_id=3, partner_user_id=None),
+    ]
+
+
+def test_select_engine():
+    users = [User(user_id=_) for _ in range(4)]
+    assert select_match_engine(users, AUTO_MATCH_ENGINE, exact_max_users=4) == EXACT_MATCH_ENGINE
+    assert select_match_engine(users, AUTO_MATCH_ENGINE, exact_max_users=3) == GREEDY_MATCH_ENGINE
+    assert select_match_engine(users, GREEDY_MATCH_ENGINE) == GREEDY_MATCH_ENGINE
+
+
+def test_random_numerators():
+    rng = random.Random(1)
+    values = random_numerators(rng, 3) / 2 ** 53
+
+    etalon = random.Random(1)
+    assert values.tolist() == [etalon.random() for _ in range(3)]
+    assert rng.random() == etalon.random()
+
+
+def test_pair_histories():
+    contacts = [
+        Contact(0, 2, 1, state=CONFIRM_STATE, feedback_score=GREAT_SCORE),
+        Contact(0, 1, 2, state=CONFIRM_STATE, feedback_score=BAD_SCORE),
+        Contact(3, 1, 2, state=FAIL_STATE),
+        Contact(3, 1, None),
+    ]
+    histories = gen_pair_histories(contacts)
+    assert histories == [
+        PairHistory(1, 2, week_index=3, state=CONFIRM_STATE, feedback_score=BAD_SCORE)
+    ]
+
+    users = [User(user_id=_) for _ in range(5)]
+    contacts = [
+        Contact(1, 0, 1),
+        Contact(1, 0, 2),
+        Contact(1, 1, 2),
+        Contact(1, 1, 4)
+    ]
+    assert (
+        list(gen_matches(users, contacts=contacts, current_week_index=2))
+        == list(gen_matches(users, pair_histories=gen_pair_histories(contacts), current_week_index=2))
+    )
@@ -0,0 +1,48 @@
+
+import pytest
+
+from neludim.obj import User
+from neludim.sqlite import SqliteDB
+from neludim.snapshot import (
+    export_snapshot,
+    import_snapshot
+)
+
+# Same tests as test_db, db fixture overridden with local backend
+from neludim.tests.test_db import (  # noqa
+    test_chats,
+    test_users,
+    test_contacts,
+    test_manual_matches,
+    test_pair_histories,
+    test_pair_histories_concurrent,
+    test_pair_histories_changed,
+    test_session,
+    test_commit_contacts,
+    test_archive_contacts,
+)
+
+
+@pytest.fixture(scope='function')
+async def db():
+    db = SqliteDB(':memory:')
+    await db.connect()
+    yield db
+    await db.close()
+
+
+class Context:
+    def __init__(self, db):
+        self.db = db
+
+
+async def test_snapshot(db, tmp_path):
+    users = [User(user_id=_, name=str(_)) for _ in range(3)]
+    await db.put_users(users)
+    await export_snapshot(Context(db), tmp_path)
+
+    other = SqliteDB(':memory:')
+    await other.connect()
+    await import_snapshot(Context(other), tmp_path)
+    assert users == await other.read_users()
+    await other.close()
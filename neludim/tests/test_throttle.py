@@ -0,0 +1,38 @@
+
+from neludim.throttle import (
+    Throttle,
+    PRIORITY
+)
+
+
+def test_throttle_rate():
+    throttle = Throttle(100)
+
+    throttle.backoff()
+    throttle.backoff()
+    assert throttle.rate == 25
+
+    for _ in range(100):
+        throttle.backoff()
+    assert throttle.rate == throttle.min_rate
+
+    for _ in range(100):
+        throttle.settle(1)
+    assert throttle.rate == 100
+
+
+async def test_throttle_priority():
+    throttle = Throttle(100)
+    throttle.tokens = -1000
+    throttle.rate = 0.001
+
+    PRIORITY.set(True)
+    await throttle.acquire(10)
+    assert throttle.tokens < -1000
+
+
+async def test_throttle_settle():
+    throttle = Throttle(1000)
+    await throttle.acquire(10)
+    throttle.settle(10, consumed=110)
+    assert throttle.tokens < 900
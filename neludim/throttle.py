@@ -0,0 +1,61 @@
+# Client side token bucket per table and capacity kind (read/write
+# units). Bulk calls wait until bucket has more than reserve share of
+# tokens, then spend, bucket may go negative, next bulk calls wait for
+# refill. Priority calls never wait, spend right away, so bulk calls
+# behind them slow down, interactive calls are not starved.
+#
+# Rate adapts AIMD style: throttling halves rate, success steps rate
+# back up to max. ConsumedCapacity from responses corrects estimated
+# cost of call.
+
+
+import asyncio
+from time import monotonic
+from contextvars import ContextVar
+
+from .const import (
+    DYNAMO_THROTTLE_RESERVE,
+    DYNAMO_THROTTLE_STEP,
+)
+
+
+# Bot middleware sets for every update, trigger ops stay bulk
+PRIORITY = ContextVar('priority', default=False)
+
+
+class Throttle:
+    def __init__(self, max_rate, reserve=DYNAMO_THROTTLE_RESERVE, step=DYNAMO_THROTTLE_STEP):
+        self.max_rate = max_rate
+        self.min_rate = max_rate / 32
+        self.rate = max_rate
+        self.step = max_rate * step
+
+        # One second burst
+        self.capacity = max_rate
+        self.reserve = self.capacity * reserve
+        self.tokens = self.capacity
+        self.updated = monotonic()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    async def acquire(self, units):
+        self.refill()
+        if not PRIORITY.get():
+            while self.tokens < self.reserve:
+                await asyncio.sleep((self.reserve - self.tokens) / self.rate)
+                self.refill()
+        self.tokens -= units
+
+    def settle(self, estimate, consumed=None):
+        if consumed is not None:
+            self.tokens -= consumed - estimate
+        self.rate = min(self.max_rate, self.rate + self.step)
+
+    def backoff(self):
+        self.rate = max(self.min_rate, self.rate / 2)
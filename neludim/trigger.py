@@ -11,11 +11,13 @@ from .log import (
 )
 from .const import (
     MONDAY,
+    WEDNESDAY,
     SATURDAY,
     SUNDAY,
 
     WEEKDAYS,
 )
+from .stats import stats_scope
 from .bot import ops
 
 
@@ -45,11 +47,15 @@ TASKS = [
     Task(SUNDAY, 9, ops.ask_participate),
 
     Task(MONDAY, 0, ops.create_contacts),
+    # Resume if 0h run hit timeout, no op if committed
+    Task(MONDAY, 9, ops.create_contacts),
     Task(MONDAY, 9, ops.send_contacts),
     Task(SATURDAY, 17, ops.ask_feedback),
 
     Task(SUNDAY, 17, ops.manual_match),
 
+    Task(WEDNESDAY, 0, ops.archive_contacts),
+
     Task(MONDAY, 0, ops.send_reports),
 ]
 
@@ -87,7 +93,11 @@ async def handle_trigger(context, request):
     tasks = select_tasks(TASKS, datetime)
     for task in tasks:
         log.info(json_msg(task=task.name))
-        await task.op(context)
+        with stats_scope() as stats:
+            async with context.db.session():
+                await task.op(context)
+        if stats.ops:
+            log.info(json_msg(task=task.name, dynamo=stats.summary()))
 
         total = len(context.broadcast.results)
         if total: